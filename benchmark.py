@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import math
+import pty
+import glob
+import time
+import fcntl
+import select
+import struct
+import shutil
+import termios
+import tempfile
+import subprocess
+
+import generate
+
+# -- Default values --------------------------------------------------------------------------------
+DEFAULT_CONFIGS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                'sample_configs', '*.json')))
+DEFAULT_BASELINE_FILE = 'benchmark_baseline.json'
+DEFAULT_ITERATIONS = 200
+DEFAULT_LOGINS = 20
+DEFAULT_THRESHOLD = 20
+# Regressions of medians smaller than this are considered noise
+MIN_REGRESSION_US = 100
+TERMINAL_SIZE = (40, 120)
+SHELL_TIMEOUT = 300
+# Generator microbenchmarks: numbers of widgets per prompt side, best of repeats is taken
+GENERATOR_SIZES = [100, 200, 400, 800]
+GENERATOR_REPEATS = 3
+# Generation time is expected to grow as size^exponent, 1 being linear and 2 quadratic
+MAX_SCALING_EXPONENT = 1.3
+
+HELP = f'''\
+Measure login and prompt rendering time of generated scripts.
+
+Usage:
+    ./benchmark.py [config_file ...] [-n N] [-l N] [-t PCT] [--baseline baseline_file] [--save]
+    ./benchmark.py --generator
+where
+    config_file - configs to benchmark. Default: all files in sample_configs
+    -n N - number of PROMPT_COMMAND and PS1 expansion iterations per scenario. Default: {DEFAULT_ITERATIONS}
+    -l N - number of script loads per scenario. Default: {DEFAULT_LOGINS}
+    -t PCT - fail if any median is slower than baseline by more than PCT percent. Default: {DEFAULT_THRESHOLD}
+    --baseline baseline_file - JSON file with baseline results. Default: "{DEFAULT_BASELINE_FILE}"
+    --save - store results as the new baseline instead of comparing with it.
+    --generator - time the generator itself on synthetic configs with {', '.join(map(str, GENERATOR_SIZES))} widgets per
+                  prompt side, and fail if it scales worse than size^{MAX_SCALING_EXPONENT}.
+'''
+
+
+# -- Scenarios -------------------------------------------------------------------------------------
+# Each scenario is (name, environment variables, setup code, teardown code). Setup code is executed
+# by the interactive shell right before measurements, {root} is replaced with the scratch directory
+SCENARIOS = [
+    ('plain', {}, 'cd "{root}/plain"', ''),
+    ('git', {}, 'cd "{root}/repo/src"', ''),
+    ('deep', {}, 'cd "{root}/plain/' + '/'.join(f'directory{i}' for i in range(16)) + '"', ''),
+    ('ssh', {'SSH_CONNECTION': '10.0.0.1 50000 10.0.0.2 22', 'SSH_TTY': '/dev/pts/0'},
+     'cd "{root}/plain"', ''),
+    ('jobs', {}, 'cd "{root}/plain"; sleep 1000 & sleep 1000 & sleep 1000 & kill -STOP %3',
+     'kill -CONT %3; kill %1 %2 %3'),
+]
+
+DRIVER = '''\
+{setup}
+for ((QB_BENCH_I = 0; QB_BENCH_I < {logins}; QB_BENCH_I++)); do
+    QB_BENCH_TS=${{EPOCHREALTIME/[.,]/}}
+    . "{script}"
+    QB_BENCH+=("{scenario} login $((${{EPOCHREALTIME/[.,]/}} - QB_BENCH_TS))")
+done
+for ((QB_BENCH_I = 0; QB_BENCH_I < {iterations}; QB_BENCH_I++)); do
+    QB_BENCH_TS=${{EPOCHREALTIME/[.,]/}}
+    eval "${{PROMPT_COMMAND}}"
+    : "${{PS1@P}}"
+    QB_BENCH+=("{scenario} prompt $((${{EPOCHREALTIME/[.,]/}} - QB_BENCH_TS))")
+done
+printf "%s\\n" "${{QB_BENCH[@]}}" > "{output}"
+{teardown}
+'''
+
+def prepare_scratch_directory(root):
+    os.makedirs(os.path.join(root, 'plain', *[f'directory{i}' for i in range(16)]))
+    os.makedirs(os.path.join(root, 'repo', 'src'))
+    os.makedirs(os.path.join(root, 'runtime'), mode = 0o700)
+    if shutil.which('git'):
+        git = ['git', '-C', os.path.join(root, 'repo'), '-c', 'user.name=qb', '-c', 'user.email=qb@localhost']
+        subprocess.run(git + ['init', '-q'], check = True)
+        with open(os.path.join(root, 'repo', 'src', 'file'), 'w') as file: file.write('content\n')
+        subprocess.run(git + ['add', '.'], check = True)
+        subprocess.run(git + ['commit', '-q', '-m', 'Initial commit'], check = True)
+        with open(os.path.join(root, 'repo', 'untracked'), 'w') as file: file.write('content\n')
+
+
+# -- Measurements ----------------------------------------------------------------------------------
+def run_interactive_shell(env, commands):
+    # Runs commands in interactive bash attached to a pseudo-terminal, just like a real login
+    pid, fd = pty.fork()
+    if pid == 0:
+        os.execvpe('bash', ['bash', '--norc', '--noprofile', '-i'], env)
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('HHHH', *TERMINAL_SIZE, 0, 0))
+    os.write(fd, f'{commands}\nexit\nexit\n'.encode())
+    deadline = time.time() + SHELL_TIMEOUT
+    while time.time() < deadline:
+        if select.select([fd], [], [], 0.1)[0]:
+            try:
+                if not os.read(fd, 65536): break
+            except OSError:
+                break
+    else:
+        os.kill(pid, 9)
+    os.waitpid(pid, 0)
+    os.close(fd)
+
+def benchmark_config(config_file, root, iterations, logins):
+    script = os.path.join(root, 'qb-prompt.sh')
+    with open(script, 'w') as file: file.write(generate.generate_script(config_file))
+    records = []
+    for scenario, variables, setup, teardown in SCENARIOS:
+        if scenario == 'git' and not shutil.which('git'):
+            continue
+        output = os.path.join(root, f'{scenario}.records')
+        driver = os.path.join(root, f'{scenario}.sh')
+        with open(driver, 'w') as file:
+            file.write(DRIVER.format(setup = setup.format(root = root), teardown = teardown,
+                                     logins = logins, iterations = iterations, script = script,
+                                     scenario = scenario, output = output))
+        env = {'PATH': os.environ.get('PATH', '/usr/bin:/bin'), 'HOME': os.path.join(root, 'plain'),
+               'TERM': 'xterm-256color', 'LANG': os.environ.get('LANG', 'C.UTF-8'),
+               'XDG_RUNTIME_DIR': os.path.join(root, 'runtime'), **variables}
+        run_interactive_shell(env, f'. "{driver}"')
+        try:
+            with open(output) as file: records += file.readlines()
+        except OSError:
+            raise RuntimeError(f'{config_file}: "{scenario}" scenario produced no results')
+    return generate.summarize_profile(records)
+
+def format_results(results):
+    lines = [f' {"Config":<28} | {"Scenario":<8} | {"Phase":<6} | {"p50":>9} | {"p95":>9} | {"p99":>9}',
+             f'{"-"*30}|{"-"*10}|{"-"*8}|{"-"*11}|{"-"*11}|{"-"*11}']
+    for config, scenarios in results.items():
+        for scenario, phases in scenarios.items():
+            for phase, pcts in phases.items():
+                lines.append(f' {config:<28} | {scenario:<8} | {phase:<6} | ' +
+                             ' | '.join(f'{pcts[pct] / 1000:>6.3f} ms' for pct in ['p50', 'p95', 'p99']))
+    return '\n'.join(lines)
+
+def find_regressions(results, baseline, threshold):
+    regressions = []
+    for config, scenarios in results.items():
+        for scenario, phases in scenarios.items():
+            for phase, pcts in phases.items():
+                reference = baseline.get(config, {}).get(scenario, {}).get(phase)
+                if reference is None:
+                    continue
+                delta = pcts['p50'] - reference['p50']
+                if delta > MIN_REGRESSION_US and delta > reference['p50'] * threshold / 100:
+                    regressions.append(f'{config} {scenario} {phase}: median {reference["p50"] / 1000:.3f} ms '
+                                       f'-> {pcts["p50"] / 1000:.3f} ms')
+    return regressions
+
+
+# -- Generator microbenchmarks ---------------------------------------------------------------------
+GENERATOR_MODES = [('plain', {}), ('memoize', {'memoize': True}), ('profile', {'benchmarking': True})]
+
+def create_synthetic_config(size):
+    # Mostly custom widgets, like in large shared configs, mixed with dynamic and login-time ones
+    kinds = [
+        lambda i: {'type': 'WG_CUSTOM', 'content': f'label{i}', 'bg': i % 256, 'fg': (i * 7) % 256},
+        lambda i: {'type': 'WG_CUSTOM', 'content': f'\\${{VALUE{i}}}', 'length': f'${{#VALUE{i}}}'},
+        lambda i: {'type': 'WG_USER_MARKER'},
+        lambda i: {'type': 'WG_CURRENT_DIR'},
+        lambda i: {'type': 'WG_ERROR_CODE'},
+    ]
+    side = lambda: [kinds[i % len(kinds)](i) for i in range(size)]
+    return {'PS1': {'left': side(), 'right': side()}, 'PS2': {'left': side()}, 'PS3': {}, 'PS4': {}}
+
+def measure_best(function, prepare, repeats):
+    # Best of repeats in seconds, prepare() result is passed to function and not measured
+    best = None
+    for _ in range(repeats):
+        argument = prepare()
+        start = time.perf_counter()
+        function(argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def benchmark_generator(sizes, repeats):
+    # Returns {mode: {phase: [seconds per size]}}
+    results = {}
+    for mode, options in GENERATOR_MODES:
+        for size in sizes:
+            config = create_synthetic_config(size)
+            phases = results.setdefault(mode, {'init': [], 'generate': []})
+            phases['init'].append(measure_best(generate.Prompts, lambda: config, repeats))
+            phases['generate'].append(measure_best(lambda prompts: prompts.generate(**options),
+                                                   lambda: generate.Prompts(config), repeats))
+    return results
+
+def get_scaling_exponent(sizes, timings):
+    return math.log(timings[-1] / timings[0]) / math.log(sizes[-1] / sizes[0])
+
+def format_generator_results(sizes, results):
+    lines = [f' {"Mode":<8} | {"Phase":<8} | ' + ' | '.join(f'{size:>9}' for size in sizes) + ' | Exponent',
+             f'{"-"*10}|{"-"*10}|' + f'{"-"*11}|' * len(sizes) + '-' * 9]
+    for mode, phases in results.items():
+        for phase, timings in phases.items():
+            lines.append(f' {mode:<8} | {phase:<8} | ' +
+                         ' | '.join(f'{timing * 1000:>6.1f} ms' for timing in timings) +
+                         f' | {get_scaling_exponent(sizes, timings):.2f}')
+    return '\n'.join(lines)
+
+def run_generator_benchmarks():
+    results = benchmark_generator(GENERATOR_SIZES, GENERATOR_REPEATS)
+    print(format_generator_results(GENERATOR_SIZES, results))
+    nonlinear = [f'{mode} {phase}' for mode, phases in results.items() for phase, timings in phases.items()
+                 if get_scaling_exponent(GENERATOR_SIZES, timings) > MAX_SCALING_EXPONENT]
+    if nonlinear:
+        print(f'\nScaling worse than size^{MAX_SCALING_EXPONENT}:' + ''.join(['\n - ' + line for line in nonlinear]))
+        exit(1)
+    print(f'\nGenerator scales no worse than size^{MAX_SCALING_EXPONENT}')
+
+
+####################################################################################################
+# -- ENTRY POINT ----------------------------------------------------------------------------------#
+####################################################################################################
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help']:
+        print(HELP)
+        exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == '--generator':
+        run_generator_benchmarks()
+        exit(0)
+    config_files = []
+    iterations = DEFAULT_ITERATIONS
+    logins = DEFAULT_LOGINS
+    threshold = DEFAULT_THRESHOLD
+    baseline_file = DEFAULT_BASELINE_FILE
+    save = False
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg in ['-n', '-l', '-t']:
+            value = next(args, '')
+            if not value.isdigit() or (arg != '-t' and int(value) == 0):
+                print(f'Invalid {arg} value: "{value}"')
+                exit(-1)
+            if arg == '-n': iterations = int(value)
+            elif arg == '-l': logins = int(value)
+            else: threshold = int(value)
+        elif arg == '--baseline':
+            baseline_file = next(args, baseline_file)
+        elif arg == '--save':
+            save = True
+        elif arg.startswith('-'):
+            print(f'Unknown option: {arg}\n\n{HELP}')
+            exit(-1)
+        else:
+            config_files.append(arg)
+    config_files = config_files or DEFAULT_CONFIGS
+
+    # Run benchmarks, results are {config: {scenario: {phase: {percentile: microseconds}}}}
+    results = {}
+    for config_file in config_files:
+        with tempfile.TemporaryDirectory(prefix = 'qb-prompt-bench.') as root:
+            prepare_scratch_directory(root)
+            try:
+                summary = benchmark_config(config_file, root, iterations, logins)
+            except (OSError, json.decoder.JSONDecodeError, RuntimeError) as error:
+                print(f'Failed to benchmark {config_file}:\n{str(error)}')
+                exit(-1)
+        config = os.path.basename(config_file)
+        for scenario, phase, count, p50, p95, p99 in summary:
+            results.setdefault(config, {}).setdefault(scenario, {})[phase] = \
+                {'p50': p50, 'p95': p95, 'p99': p99}
+    print(format_results(results))
+
+    if save:
+        with open(baseline_file, 'w') as file: json.dump(results, file, indent = 4)
+        print(f'\nBaseline saved to "{baseline_file}"')
+        exit(0)
+    try:
+        with open(baseline_file) as file: baseline = json.load(file)
+    except FileNotFoundError:
+        print(f'\nNo baseline "{baseline_file}" to compare with, use --save to create it')
+        exit(0)
+    regressions = find_regressions(results, baseline, threshold)
+    if regressions:
+        print(f'\nRegressions over {threshold}%:' + ''.join(['\n - ' + line for line in regressions]))
+        exit(1)
+    print(f'\nNo regressions over {threshold}% compared to "{baseline_file}"')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 
 import re
+import os
 import json
 import sys
+import hashlib
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 if sys.version_info < (3,6):
     print('Minimal required python version is 3.6. Sorry :(')
@@ -20,16 +25,48 @@ DEFAULT_CONTENT = ''
 DEFAULT_CONFIG_FILE = 'sample_configs/default.json'
 DEFAULT_OUTPUT_FILE = 'qb-prompt.sh'
 PROFILING_INFO_FILE = '/tmp/qb-prompt.profile'
+DEFAULT_CACHE_FILE = '.qb-prompt-cache.json'
+# Environment variables which may be resolved at generation time with --bake
+BAKEABLE_FACTS = ['UID', 'USER', 'HOME', 'SSH_TTY', 'TERM']
 
 HELP = f'''\
 Generate bash prompt configuration script.
 
 Usage:
-    ./generate.py [config_file|-] [output_file] [-b|--benchmark]
+    ./generate.py [config_file|-] [output_file] [-b|--benchmark] [-c|--costs] [--bytes] [-m|--memoize]
+                                               [--max-forks-per-prompt N] [--zero-fork-login]
+                                               [--bake NAME=VALUE ...] [--layout] [--lazy] [--fast-ps4]
+                                               [-w|--watch [--delta delta_file]]
+    ./generate.py batch batch_file [-j|--jobs N] [--cache cache_file] [options]
+    ./generate.py profile [profile_file]
 where
     config_file - input json-formatted configuration file ('-' for default). Default: "{DEFAULT_CONFIG_FILE}"
-    output_file - output bash prompt configuration script. Default: "{DEFAULT_OUTPUT_FILE}"\
-    -b --benchmark - add benchmarks, measuring script loading and prompt rendering time.
+    output_file - output bash prompt configuration script. Default: "{DEFAULT_OUTPUT_FILE}"
+    -b --benchmark - add benchmarks, measuring script loading and prompt rendering time per widget.
+    -c --costs - print estimated forks, subprocesses, subshells and pipelines per widget at login and per prompt.
+    --bytes - print literal bytes sent to terminal per prompt with all widgets shown, before and after
+              merging and dropping redundant escape sequences. Expansions are not counted.
+    -m --memoize - skip re-rendering prompts when widget inputs haven't changed since the previous prompt.
+    --max-forks-per-prompt N - fail if estimated number of forks per prompt exceeds N.
+    --zero-fork-login - fail if any widget would fork a process at login.
+    --bake NAME=VALUE - resolve environment variable at generation time for per-user scripts, folding
+                        conditions and lengths that depend on it into literals. Can be repeated.
+                        Supported: {', '.join(BAKEABLE_FACTS)}
+    --layout - recompute values depending on terminal width only when it changes, and align right prompt
+               relative to the right edge, so that it stays aligned when redrawn after resize.
+    --lazy - render PS2 only when it is displayed, instead of before every PS1. PS3 and dynamic PS4
+             widgets are still rendered before every PS1.
+    --fast-ps4 - fail if PS4 would run any command substitution or prompt command code, so that
+                 tracing with "set -x" doesn't fork on every traced line.
+    -w --watch - poll config_file and regenerate output_file whenever it changes, reusing unchanged widgets.
+    --delta delta_file - in watch mode, also write the script part changed since the previous generation,
+                         which can be sourced from a running shell instead of the whole output_file.
+    batch - generate multiple prompts in parallel, one "config_file output_file" pair per line of
+            batch_file. Outputs whose config content, options and generator version haven't changed
+            since the previous run are skipped. Accepts the same options as a single generation.
+    -j --jobs N - number of parallel batch processes. Default: number of CPUs.
+    --cache cache_file - batch cache of config hashes. Default: "{DEFAULT_CACHE_FILE}"
+    profile - summarize benchmark records from profile_file. Default: "{PROFILING_INFO_FILE}"
 '''
 
 
@@ -43,7 +80,11 @@ F_SAVE_CURSOR    = '\e[s'
 F_RESTORE_CURSOR = '\e[u'
 F_MOVE_CURSOR_B  = '\e['
 F_MOVE_CURSOR_E  = 'C'
-NULL_STRING = '#>> to be wiped <<#'
+F_MOVE_CURSOR_BACK_E = 'D'
+EPOCH_US = '${EPOCHREALTIME/[.,]/}'
+# Memoization inputs which differ on almost every prompt, prompts depending on them are never
+# memoized, as fingerprint comparison would only add up to their rendering time
+VOLATILE_DEPENDENCIES = ['${COMMAND_TIME}']
 
 
 # -- Helper functions ------------------------------------------------------------------------------
@@ -62,6 +103,24 @@ def convert_formatting(fmt):
     else:
         return None
 
+def convert_number(num):
+    if isinstance(num, int) and num >= 0:
+        return num
+    else:
+        return None
+
+def profile(statements, name, phase):
+    # Measured statements are kept as is, so that optimization passes still apply to them
+    return Block(None, [Code(f'QB_PROFILE_TS={EPOCH_US}'), *statements,
+                        Code(f'QB_PROFILE+=("{name} {phase} $(({EPOCH_US} - QB_PROFILE_TS))")')])
+
+def strip_trailing_spaces(code):
+    return re.sub(' *$', '', code, flags = re.M)
+
+def convert_cache_key(key):
+    # Either variable name or shell expression
+    return f'${{{key}}}' if re.fullmatch(r'[A-Za-z_]\w*', key) else key
+
 def indent(code, size):
     if size < 0:
         strip = re.compile(f' {{,{-size}}}(.*)')
@@ -70,8 +129,961 @@ def indent(code, size):
         return '\n'.join(' '*size + line for line in code.splitlines())
 
 
+# -- Shell IR --------------------------------------------------------------------------------------
+# Generated script is built as a tree of statements, transformed by optimization passes below,
+# and emitted as text only at the end
+class Code:
+    # Opaque shell code, which is never transformed
+    def __init__(self, text): self.text = text.rstrip()
+
+    def children(self): return []
+
+    def references(self): return self.text
+
+    def is_empty(self): return not self.text.strip()
+
+    def emit(self): return self.text
+
+class Assign:
+    def __init__(self, name, value):
+        self.name = name
+        self.value = str(value)
+
+    def children(self): return []
+
+    def references(self): return self.value
+
+    def is_empty(self): return False
+
+    def emit(self):
+        if self.value.isdigit():
+            return f'{self.name}={self.value}'
+        return f'{self.name}="{self.value}"'
+
+class If:
+    def __init__(self, condition, body, orelse = []):
+        self.condition = condition
+        self.body = filter_statements(body)
+        self.orelse = filter_statements(orelse)
+
+    def children(self): return self.body + self.orelse
+
+    def references(self): return self.condition
+
+    def is_empty(self): return not self.body and not self.orelse
+
+    def emit(self):
+        lines = [f'if {self.condition}; then', indent(emit(self.body) or ':', 4)]
+        if self.orelse:
+            lines += ['else', indent(emit(self.orelse), 4)]
+        return '\n'.join(lines + ['fi'])
+
+class Block:
+    # Statements generated by single widget or other part of generator, separated by empty line
+    def __init__(self, label, body):
+        self.label = label
+        self.body = filter_statements(body)
+
+    def children(self): return self.body
+
+    def references(self): return ''
+
+    def is_empty(self): return not self.body
+
+    def emit(self):
+        label = f'\n# {self.label}' if self.label else ''
+        return f'{label}\n{emit(self.body)}'
+
+class Function:
+    # Shell function definition, its body is optimized as any other statements
+    def __init__(self, name, body):
+        self.name = name
+        self.body = filter_statements(body)
+
+    def children(self): return self.body
+
+    def references(self): return ''
+
+    def is_empty(self): return False
+
+    def emit(self):
+        return '\n'.join([f'{self.name}() {{', indent(emit(self.body) or ':', 4), '}'])
+
+def parse_code(text):
+    # Simple assignments of double-quoted values are parsed, so that optimization passes can see
+    # through them, anything else is kept opaque
+    parts = [re.fullmatch(r'([A-Za-z_]\w*)="([^"\\`]*)"', part.strip()) for part in text.split(';')]
+    if text.strip() and all(parts):
+        return [Assign(part.group(1), part.group(2)) for part in parts]
+    return [Code(text)]
+
+def filter_statements(statements):
+    return [statement for statement in statements if statement is not None and not statement.is_empty()]
+
+def emit(statements):
+    return '\n'.join(statement.emit() for statement in statements)
+
+def walk(statements):
+    for statement in statements:
+        yield statement
+        yield from walk(statement.children())
+
+def rebuild(statements, transform):
+    # Applies transform to each statement bottom-up, transform returns new statement, list of
+    # statements to splice in place of the old one, or None
+    result = []
+    for statement in statements:
+        if isinstance(statement, If):
+            statement = If(statement.condition, rebuild(statement.body, transform),
+                           rebuild(statement.orelse, transform))
+        elif isinstance(statement, Block):
+            statement = Block(statement.label, rebuild(statement.body, transform))
+        elif isinstance(statement, Function):
+            statement = Function(statement.name, rebuild(statement.body, transform))
+        statement = transform(statement)
+        result += filter_statements(statement if isinstance(statement, list) else [statement])
+    return result
+
+def find_references(name, text):
+    return re.findall(f'(?<!\\w){name}(?!\\w)', text)
+
+def count_references(text):
+    # Number of references of every name in text at once, see find_references()
+    return Counter(re.findall(r'\w+', text))
+
+def find_deferred_substitutions(sections, name):
+    # Command substitutions which are kept escaped in the value of the variable, or of variables
+    # expanded in it, so that they are run whenever the variable itself is expanded
+    values = {}
+    for statement in walk([statement for section in sections.values() for statement in section]):
+        if isinstance(statement, Assign):
+            values.setdefault(statement.name, []).append(statement.value)
+    substitutions = []
+    pending = [name]
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen: continue
+        seen.add(name)
+        for value in values.get(name, []):
+            substitutions += re.findall(r'\\\$\((?!\()[^)]*\)?|\\`[^`]*`?', value)
+            pending += re.findall(r'(?<!\\)\$\{(\w+)\}', value)
+    return substitutions
+
+def eliminate_common_blocks(statements):
+    # Repeated block is redundant if nothing since its last occurrence could change what it
+    # computes. Opaque code might change anything, so it stops the search
+    result = []
+    occurrences = {}
+    assignments = {}
+    last_opaque = -1
+    for statement in statements:
+        text = statement.emit()
+        if isinstance(statement, Block) and text in occurrences:
+            index = occurrences[text]
+            if index >= last_opaque and not any(assigned > index and find_references(name, text)
+                                                for name, assigned in assignments.items()):
+                continue
+        occurrences[text] = len(result)
+        for nested in walk([statement]):
+            if isinstance(nested, Code): last_opaque = len(result)
+            if isinstance(nested, Assign): assignments[nested.name] = len(result)
+        result.append(statement)
+    return result
+
+def evaluate_condition(condition):
+    # True or False for conditions of literal values, None if it's only known at runtime
+    if condition in [':', 'true', 'false']:
+        return condition != 'false'
+    match = re.fullmatch(r'\[ (-?\d+) -(eq|ne|lt|le|gt|ge) (-?\d+) \]', condition)
+    if match:
+        left, right = int(match.group(1)), int(match.group(3))
+        return {'eq': left == right, 'ne': left != right, 'lt': left < right, 'le': left <= right,
+                'gt': left > right, 'ge': left >= right}[match.group(2)]
+    match = re.fullmatch(r'\[ "([^"\\$`]*)" (!?=) "([^"\\$`]*)" \]', condition)
+    if match:
+        return (match.group(1) == match.group(3)) == (match.group(2) == '=')
+    match = re.fullmatch(r'\[ -([nz]) "([^"\\$`]*)" \]', condition)
+    if match:
+        return bool(match.group(2)) == (match.group(1) == 'n')
+    return None
+
+def fold_arithmetic(value):
+    # Sums of literal numbers, e.g. lengths of baked values
+    return re.sub(r'\$\(\((\s*-?\d+(\s*[-+]\s*\d+)*\s*)\)\)',
+                  lambda match: str(sum(int(number.replace(' ', ''))
+                                        for number in re.findall(r'[-+]?\s*\d+', match.group(1)))), value)
+
+def bake_facts(sections, facts):
+    # Known environment variables are replaced with their values in conditions and assignments.
+    # Expansions escaped with odd number of backslashes are left for the shell to expand later
+    def substitute(code):
+        for name, value in facts.items():
+            quoted = re.sub(r'([\\"$`])', r'\\\1', value)
+            code = re.sub(rf'(?<!\\)((?:\\\\)*)\$\{{(#?){name}\}}', lambda match: match.group(1) +
+                          (str(len(value)) if match.group(2) else quoted), code)
+        return code
+
+    def bake_statement(statement):
+        if isinstance(statement, Assign):
+            return Assign(statement.name, fold_arithmetic(substitute(statement.value)))
+        if isinstance(statement, If):
+            return If(substitute(statement.condition), statement.body, statement.orelse)
+        return statement
+    return {name: rebuild(statements, bake_statement) for name, statements in sections.items()}
+
+def unconditional_assignments(statements):
+    # Assignments which are run whenever statements are, i.e. not nested in conditions or functions
+    for statement in statements:
+        if isinstance(statement, Assign):
+            yield statement
+        elif isinstance(statement, Block):
+            yield from unconditional_assignments(statement.body)
+
+def fold_constants(sections, static_section, protected):
+    # Conditions which are known to be true or false are replaced with the taken branch
+    def fold_condition(statement):
+        if isinstance(statement, If):
+            result = evaluate_condition(statement.condition)
+            if result is not None:
+                return statement.body if result else statement.orelse
+        return statement
+    sections = {name: rebuild(statements, fold_condition) for name, statements in sections.items()}
+
+    # Variables assigned once with literal value at the top level of static section are inlined,
+    # if they are only referenced in other assignments
+    statements = [statement for section in sections.values() for statement in walk(section)]
+    assignments = [statement for statement in statements if isinstance(statement, Assign)]
+    values = '\n'.join(assignment.value for assignment in assignments)
+    others = '\n'.join(statement.references() for statement in statements if not isinstance(statement, Assign))
+    top_level = list(unconditional_assignments(sections[static_section]))
+    assignment_counts = Counter(assignment.name for assignment in assignments)
+    other_references = count_references(others)
+    value_references = count_references(values)
+    value_expansions = Counter(re.findall(r'\$\{(\w+)\}', values))
+    constants = {}
+    for assignment in top_level:
+        name = assignment.name
+        if name not in protected and not re.search(r'[$`]', assignment.value) and \
+           assignment_counts[name] == 1 and not other_references[name] and \
+           value_references[name] == value_expansions[name]:
+            constants[name] = assignment.value
+
+    def inline_constants(statement):
+        if isinstance(statement, Assign):
+            # Constants never contain expansions, so they are substituted in a single pass
+            value = re.sub(r'\$\{(\w+)\}', lambda match: constants.get(match.group(1), match.group(0)),
+                           statement.value)
+            return Assign(statement.name, fold_arithmetic(value))
+        return statement
+    return {name: rebuild(statements, inline_constants) for name, statements in sections.items()}
+
+def eliminate_dead_variables(sections, protected):
+    # Assignments of variables which are never referenced are removed, until nothing changes
+    while True:
+        statements = [statement for section in sections.values() for statement in walk(section)]
+        references = count_references('\n'.join(statement.references() for statement in statements))
+        dead = {statement.name for statement in statements if isinstance(statement, Assign) and
+                statement.name not in protected and not references[statement.name]}
+        if not dead:
+            return sections
+        sections = {name: rebuild(section, lambda statement: None if isinstance(statement, Assign) and
+                                  statement.name in dead else statement)
+                    for name, section in sections.items()}
+
+def minimize_escapes(statement):
+    if isinstance(statement, Assign):
+        return Assign(statement.name, minimize_sgr(statement.value))
+    return statement
+
+def optimize(sections, static_section, protected, facts = {}):
+    sections = bake_facts(sections, facts)
+    sections = {name: eliminate_common_blocks(rebuild(statements, minimize_escapes))
+                for name, statements in sections.items()}
+    sections = fold_constants(sections, static_section, protected)
+    # Inlined values may bring adjacent escape sequences together
+    sections = {name: rebuild(statements, minimize_escapes) for name, statements in sections.items()}
+    return eliminate_dead_variables(sections, protected)
+
+
+# -- Escape sequences ------------------------------------------------------------------------------
+# Prompt strings are minimized by tracking terminal attributes set by SGR sequences ("\e[...m"),
+# so that consecutive sequences are merged, and attributes which are overridden or already set
+# are dropped. Anything that might print escape sequences itself resets tracking
+SGR_SEQUENCE = re.compile(r'\\e\[([0-9;]*)m')
+SGR_DEFAULTS = {'bold': '22', 'faint': '22', 'italic': '23', 'bg': '49', 'fg': '39'}
+
+def tokenize_prompt(code):
+    # Splits prompt string into (kind, text) tokens, where kind is one of: "sgr", "open" and
+    # "close" for non-printing sequence markers, "barrier" for expansions and other escapes.
+    # Tokens are collected as [kind, start, end] spans, so that merging text is cheap
+    spans = []
+    pos = 0
+    while pos < len(code):
+        sgr = SGR_SEQUENCE.match(code, pos)
+        if sgr:
+            end, kind = sgr.end(), 'sgr'
+        elif code.startswith('\\[', pos) or code.startswith('\\]', pos):
+            end, kind = pos + 2, 'open' if code[pos + 1] == '[' else 'close'
+        elif code.startswith('\\e', pos):
+            end, kind = re.compile(r'\\e(\[[0-9;]*[A-Za-z]?)?').match(code, pos).end(), 'barrier'
+        elif code[pos] in '$`' or code.startswith('\\$', pos) or code.startswith('\\`', pos):
+            # Variables and substitutions, either expanded on assignment or on prompt expansion
+            start = pos + 1 if code[pos] == '\\' else pos
+            end, kind = start + 1, 'barrier'
+            if code[start] == '`':
+                end = find_closing(code, end, '`', '`') + 1
+            elif code.startswith('{', end) or code.startswith('(', end):
+                end = find_closing(code, end + 1, code[end], '}' if code[end] == '{' else ')') + 1
+            elif re.match(r'\w', code[end:end + 1]):
+                end = re.compile(r'\w*').match(code, end).end()
+            elif code[pos] == '$':
+                kind = 'text'
+        else:
+            end, kind = pos + 2 if code[pos] == '\\' else pos + 1, 'text'
+        if kind == 'text' and spans and spans[-1][0] == 'text':
+            spans[-1][2] = end
+        else:
+            spans.append([kind, pos, end])
+        pos = end
+    return [(kind, code[start:end]) for kind, start, end in spans]
+
+def parse_sgr(params):
+    # List of (attribute, code) pairs, where attribute is None for reset, or None if there are
+    # parameters which are not tracked
+    codes = params.split(';')
+    changes = []
+    pos = 0
+    while pos < len(codes):
+        code = codes[pos]
+        number = int(code) if code.isdigit() else 0 if code == '' else -1
+        if number == 0: changes.append((None, '0'))
+        elif number == 1: changes.append(('bold', code))
+        elif number == 2: changes.append(('faint', code))
+        elif number == 22: changes += [('bold', code), ('faint', code)]
+        elif number in [3, 23]: changes.append(('italic', code))
+        elif number in [38, 48] and codes[pos + 1:pos + 2] in [['5'], ['2']]:
+            size = 3 if codes[pos + 1] == '5' else 5
+            if len(codes) < pos + size: return None
+            changes.append(('fg' if number == 38 else 'bg', ';'.join(codes[pos:pos + size])))
+            pos += size - 1
+        elif 30 <= number <= 37 or 90 <= number <= 97 or number == 39: changes.append(('fg', code))
+        elif 40 <= number <= 47 or 100 <= number <= 107 or number == 49: changes.append(('bg', code))
+        else: return None
+        pos += 1
+    return changes
+
+def minimize_sgr_run(params, state):
+    # Shortest parameters with the same effect as the run of sequences in given state, which is
+    # {attribute: code} of known attributes, with "clean" key if no untracked attributes are set
+    changes = parse_sgr(';'.join(params))
+    if changes is None:
+        return (';'.join(param or '0' for param in params), {})
+    final = dict(state)
+    reset = False
+    for attribute, code in changes:
+        if attribute is None:
+            reset = True
+            final = {'clean': True, **SGR_DEFAULTS}
+        else:
+            final.pop(attribute, None)
+            final[attribute] = code
+    candidates = []
+    if not reset or (state.get('clean') and all(attribute in state for attribute in SGR_DEFAULTS)):
+        codes = [code for attribute, code in final.items()
+                 if attribute != 'clean' and state.get(attribute) != code]
+        if '22' in codes:
+            # Normal intensity clears both bold and faint, so the one still set is set again after it
+            codes = [code for code in codes if code not in ['1', '2', '22']] + ['22'] + \
+                    [final[attribute] for attribute in ['bold', 'faint'] if final.get(attribute, '22') != '22']
+        candidates.append(codes)
+    if reset:
+        candidates.append(['0'] + [code for attribute, code in final.items()
+                                   if attribute != 'clean' and code != SGR_DEFAULTS[attribute]])
+    return (min((';'.join(codes) for codes in candidates), key = len), final)
+
+def minimize_sgr(code):
+    if '\\e' not in code and '\\[' not in code:
+        return code
+    tokens = tokenize_prompt(code)
+    result = []
+    state = {}
+    pos = 0
+    while pos < len(tokens):
+        kind, text = tokens[pos]
+        if kind == 'sgr':
+            # Sequences separated by nothing but closing and reopening non-printing markers
+            params = [SGR_SEQUENCE.match(text).group(1)]
+            pos += 1
+            while True:
+                if tokens[pos:pos + 1] and tokens[pos][0] == 'sgr':
+                    params.append(SGR_SEQUENCE.match(tokens[pos][1]).group(1))
+                    pos += 1
+                elif [token[0] for token in tokens[pos:pos + 3]] == ['close', 'open', 'sgr']:
+                    params.append(SGR_SEQUENCE.match(tokens[pos + 2][1]).group(1))
+                    pos += 3
+                else:
+                    break
+            params, state = minimize_sgr_run(params, state)
+            if params:
+                result.append(('sgr', f'\\e[{params}m'))
+            continue
+        if kind == 'close' and result and result[-1][0] == 'open':
+            result.pop()
+        else:
+            result.append((kind, text))
+        if kind == 'barrier':
+            state = {}
+        pos += 1
+    return ''.join(text for kind, text in result)
+
+def count_terminal_bytes(code):
+    # Literal bytes only: non-printing markers are not sent to terminal, escape character is a single
+    # byte, and expansions left in the prompt are not counted, as their output is only known at runtime
+    return sum(len(text.replace('\\e', '\x1b').encode()) for kind, text in tokenize_prompt(code)
+               if kind in ['sgr', 'text'] or kind == 'barrier' and text.startswith('\\e'))
+
+def format_bytes_report(rows):
+    header = f' {"PS":<4} | {"Before":>7} | {"After":>7} | {"Saved":>6}'
+    lines = [header, '-' * len(header)]
+    for ps_name, before, after in rows + [('', sum(row[1] for row in rows), sum(row[2] for row in rows))]:
+        if not ps_name: lines.append('-' * len(header))
+        saved = f'{(before - after) * 100 / before:.1f}%' if before else '-'
+        lines.append(f' {ps_name or "All":<4} | {before:>7} | {after:>7} | {saved:>6}')
+    return '\n'.join(lines)
+
+
+# -- Shared functions ------------------------------------------------------------------------------
+# Shell functions shared by several widgets. Each one is defined once at login. Probes are also
+# called once per prompt before any widget code, no matter how many widgets depend on them.
+GIT_PROBE = '''
+# Find git repository root and current branch using builtins only
+__qb_git_probe() {
+    local dir="${PWD}" gitdir head
+    until [ -e "${dir}/.git" ]; do
+        if [ -z "${dir}" ]; then
+            QB_GIT_ROOT=""
+            return
+        fi
+        dir="${dir%/*}"
+    done
+    if [ "${dir}" != "${QB_GIT_ROOT}" ]; then
+        QB_GIT_ROOT="${dir}"
+        QB_GIT_HEAD=""
+        gitdir="${dir}/.git"
+        # Worktrees and submodules have a file pointing to the actual git directory
+        if [ -f "${gitdir}" ]; then
+            read -r gitdir 2> /dev/null < "${gitdir}"
+            gitdir="${gitdir#gitdir: }"
+            [ "${gitdir:0:1}" != "/" ] && gitdir="${dir}/${gitdir}"
+        fi
+        QB_GIT_GITDIR="${gitdir}"
+    fi
+    read -r head 2> /dev/null < "${QB_GIT_GITDIR}/HEAD"
+    if [ "${head}" != "${QB_GIT_HEAD}" ]; then
+        QB_GIT_HEAD="${head}"
+        case "${head}" in
+            "ref: refs/heads/"*) GIT_BRANCH="${head#ref: refs/heads/}" ;;
+            "ref: "*) GIT_BRANCH="${head#ref: }" ;;
+            *) GIT_BRANCH="${head:0:7}" ;;
+        esac
+    fi
+}
+'''
+
+GIT_STATUS_FUNCTIONS = '''
+# Compute git status counters in background and store them to per-repository cache file
+__qb_git_status_refresh() {
+    local ts="${EPOCHSECONDS}" tmp="$2.${BASHPID}" line staged=0 dirty=0 untracked=0 ahead=0 behind=0
+    if ! GIT_OPTIONAL_LOCKS=0 git -C "$1" status --porcelain=v2 --branch > "${tmp}" 2> /dev/null; then
+        rm -f "${tmp}" "$2.pending"
+        return
+    fi
+    while IFS= read -r line; do
+        case "${line}" in
+            "# branch.ab "*)
+                line="${line#\\# branch.ab +}"
+                ahead="${line%% *}"
+                behind="${line##*-}" ;;
+            "? "*)
+                untracked=$((untracked + 1)) ;;
+            [12u]" "*)
+                [ "${line:2:1}" != "." ] && staged=$((staged + 1))
+                [ "${line:3:1}" != "." ] && dirty=$((dirty + 1)) ;;
+        esac
+    done < "${tmp}"
+    echo "${ts} ${staged} ${dirty} ${untracked} ${ahead} ${behind}" > "${tmp}" && mv -f "${tmp}" "$2"
+    rm -f "$2.pending"
+}
+
+# Show last known git status immediately, refresh it in background when outdated
+__qb_git_status() {
+    local refresh="$1" max_stale="$2" stale_marker="$3" file ts=0 pending=0 staged dirty untracked ahead
+    local behind stale
+    GIT_STATUS=""
+    # Cache files are kept only in the private scratch directory, so that nobody can fake them
+    [ -z "${QB_GIT_ROOT}" ] || [ -z "${QB_SCRATCH_DIR}" ] && return
+    file="${QB_SCRATCH_DIR}/git-status${QB_GIT_ROOT//\\//%}"
+    [ -f "${file}" ] && read -r ts staged dirty untracked ahead behind 2> /dev/null < "${file}"
+    if [ $((EPOCHSECONDS - ts)) -ge ${refresh} ] || [[ "${QB_GIT_GITDIR}/index" -nt "${file}" ]] ||
+            [[ "${QB_GIT_GITDIR}/HEAD" -nt "${file}" ]]; then
+        stale=1
+        # Don't spawn another refresh while previous one for this repository is in progress. Its
+        # start time is kept in a file rather than a variable, so that it survives evaluation in a
+        # subshell (see "timeout_ms") and is shared by all shells
+        [ -f "${file}.pending" ] && read -r pending 2> /dev/null < "${file}.pending"
+        if [ ${ts} -ge ${pending} ] || [ $((EPOCHSECONDS - pending)) -ge ${max_stale} ]; then
+            echo "${EPOCHSECONDS}" 2> /dev/null > "${file}.pending"
+            ( __qb_git_status_refresh "${QB_GIT_ROOT}" "${file}" < /dev/null &> /dev/null & )
+        fi
+    fi
+    [ ${ts} -eq 0 ] || [ $((EPOCHSECONDS - ts)) -gt ${max_stale} ] && return
+    [ ${staged} -gt 0 ] && GIT_STATUS+=" +${staged}"
+    [ ${dirty} -gt 0 ] && GIT_STATUS+=" !${dirty}"
+    [ ${untracked} -gt 0 ] && GIT_STATUS+=" ?${untracked}"
+    [ ${ahead} -gt 0 ] && GIT_STATUS+=" ↑${ahead}"
+    [ ${behind} -gt 0 ] && GIT_STATUS+=" ↓${behind}"
+    GIT_STATUS="${GIT_STATUS# }"
+    [ -n "${GIT_STATUS}" ] && [ -n "${stale}" ] && GIT_STATUS+="${stale_marker}"
+}
+'''
+
+SCRATCH_DIR_SETUP = '''
+# Private per-user directory for scratch files, so that other users can't plant, replace or read
+# them. It is created with 0700 mode (the only fork, done once while it doesn't exist), an existing
+# one is used only if it is owned by the user and is not a symlink. Otherwise scratch files are off
+QB_SCRATCH_DIR="${XDG_RUNTIME_DIR:-${TMPDIR:-/tmp}}/qb-prompt-${UID}"
+[ -d "${QB_SCRATCH_DIR}" ] || mkdir -m 700 "${QB_SCRATCH_DIR}" 2> /dev/null
+if [ -L "${QB_SCRATCH_DIR}" ] || [ ! -d "${QB_SCRATCH_DIR}" ] || [ ! -O "${QB_SCRATCH_DIR}" ]; then
+    QB_SCRATCH_DIR=""
+fi
+
+# Per-shell scratch files "*.<pid>" are removed on exit. Existing EXIT trap is read back through
+# scratch file without forking, and is run before the removal
+__qb_scratch_trap() {
+    local trap cleanup
+    trap -p EXIT > "${QB_SCRATCH_DIR}/trap.$$" 2> /dev/null || return
+    read -r -d "" trap < "${QB_SCRATCH_DIR}/trap.$$"
+    eval "set -- ${trap}"
+    printf -v cleanup 'rm -f %q/*.%s 2> /dev/null' "${QB_SCRATCH_DIR}" "$$"
+    [[ "$3" == *"${cleanup}"* ]] || trap "${3:+$3; }${cleanup}" EXIT
+}
+[ -n "${QB_SCRATCH_DIR}" ] && __qb_scratch_trap
+'''
+
+JOBS_COUNT_FUNCTION = '''
+# Count background jobs without forking: \\j prompt escape for all jobs, jobs builtin output
+# redirected to per-shell scratch file for running (-r) or stopped (-s) ones only
+__qb_jobs_count() {
+    local pids='\\j'
+    JOBS_NUM="${pids@P}"
+    if [ -n "$1" ] && [ ${JOBS_NUM} -gt 0 ] && [ -n "${QB_SCRATCH_DIR}" ]; then
+        local file="${QB_SCRATCH_DIR}/jobs.$$"
+        jobs "$1" -p 2> /dev/null > "${file}" || return
+        mapfile -t pids < "${file}"
+        JOBS_NUM=${#pids[@]}
+    fi
+}
+'''
+
+COMMAND_TIME_PROBE = '''
+# Measure wall time of the last command without forking: PS0 is expanded right before command
+# execution, and arithmetic in its empty substring expansion stores start timestamp
+QB_COMMAND_NUL=""
+if [[ "${PS0}" != *QB_COMMAND_TS* ]]; then
+    PS0='${QB_COMMAND_NUL:$((QB_COMMAND_TS=${EPOCHREALTIME/[.,]/}))}'"${PS0}"
+fi
+__qb_command_time() {
+    COMMAND_TIME=0
+    if [ -n "${QB_COMMAND_TS}" ]; then
+        COMMAND_TIME=$(((${EPOCHREALTIME/[.,]/} - QB_COMMAND_TS) / 1000))
+        QB_COMMAND_TS=""
+    fi
+}
+'''
+
+COMMAND_DURATION_FUNCTION = '''
+# Format last command time in given units: "ms", "s", "m" (minutes and seconds), "h" (hours and
+# minutes) or "auto" (the largest units below the time)
+__qb_command_duration() {
+    local ms="${COMMAND_TIME}" units="$1"
+    if [ "${units}" = "auto" ]; then
+        if [ ${ms} -lt 1000 ]; then units="ms"
+        elif [ ${ms} -lt 60000 ]; then units="s"
+        elif [ ${ms} -lt 3600000 ]; then units="m"
+        else units="h"
+        fi
+    fi
+    case "${units}" in
+        ms) COMMAND_DURATION="${ms}ms" ;;
+        s) COMMAND_DURATION="$((ms / 1000)).$((ms / 100 % 10))s" ;;
+        m) printf -v COMMAND_DURATION "%dm%02ds" $((ms / 60000)) $((ms / 1000 % 60)) ;;
+        h) printf -v COMMAND_DURATION "%dh%02dm" $((ms / 3600000)) $((ms / 60000 % 60)) ;;
+    esac
+}
+'''
+
+KUBE_CONTEXT_PROBE = '''
+# Read current kubernetes context from kubeconfig files with builtins. Files are re-read when the
+# list, existence or emptiness of any of them changes, or its modification time differs in either
+# direction from the one copied to per-shell stamp file, e.g. after removal or "cp -p" of a backup.
+# Only copying it on re-read forks. Without scratch directory, files are re-read on every prompt
+__qb_kube_context() {
+    local configs="${KUBECONFIG:-${HOME}/.kube/config}" config line index=0 signature changed
+    local stamp="${QB_SCRATCH_DIR}/kube" rest="${configs}:"
+    while [ -n "${rest}" ]; do
+        config="${rest%%:*}"
+        rest="${rest#*:}"
+        if [ -s "${config}" ]; then signature+="s"
+        elif [ -e "${config}" ]; then signature+="e"
+        else signature+="-"
+        fi
+        [ -e "${config}" ] && [[ "${config}" -nt "${stamp}${index}.$$" ||
+                                 "${config}" -ot "${stamp}${index}.$$" ]] && changed=1
+        index=$((index + 1))
+    done
+    signature="${configs}|${signature}"
+    [ "${signature}" != "${QB_KUBE_SIGNATURE}" ] || [ -z "${QB_SCRATCH_DIR}" ] && changed=1
+    [ -z "${changed}" ] && return
+    QB_KUBE_SIGNATURE="${signature}"
+    KUBE_CONTEXT=""
+    rest="${configs}:"
+    index=0
+    while [ -n "${QB_SCRATCH_DIR}" ] && [ -n "${rest}" ]; do
+        config="${rest%%:*}"
+        rest="${rest#*:}"
+        [ -e "${config}" ] && touch -r "${config}" "${stamp}${index}.$$" 2> /dev/null
+        index=$((index + 1))
+    done
+    # Like kubectl, take the context from the first file which sets it
+    rest="${configs}:"
+    while [ -z "${KUBE_CONTEXT}" ] && [ -n "${rest}" ]; do
+        config="${rest%%:*}"
+        rest="${rest#*:}"
+        [ -r "${config}" ] || continue
+        while IFS= read -r line || [ -n "${line}" ]; do
+            if [[ "${line}" == "current-context:"* ]]; then
+                line="${line#current-context:}"
+                line="${line#"${line%%[![:space:]]*}"}"
+                line="${line%"${line##*[![:space:]]}"}"
+                # Patterns with quotes are left unquoted, as assignments are not split anyway
+                line=${line#[\\"\\']}
+                KUBE_CONTEXT=${line%[\\"\\']}
+                break
+            fi
+        done < "${config}"
+    done
+}
+'''
+
+CONTAINER_DETECT_FUNCTION = '''
+# Detect container runtime using builtins only: "container" variable set by systemd-nspawn, podman
+# and toolbox, marker files left by docker and podman, and control groups of the init process
+__qb_container_detect() {
+    local line
+    CONTAINER="${container}"
+    if [ -n "${CONTAINER}" ]; then return
+    elif [ -f /.dockerenv ]; then CONTAINER="docker"
+    elif [ -f /run/.containerenv ]; then CONTAINER="podman"
+    elif [ -n "${KUBERNETES_SERVICE_HOST}" ]; then CONTAINER="kubernetes"
+    elif [ -r /proc/1/cgroup ]; then
+        while IFS= read -r line; do
+            case "${line}" in
+                *kubepods*) CONTAINER="kubernetes"; break ;;
+                *docker*) CONTAINER="docker"; break ;;
+                *lxc*) CONTAINER="lxc"; break ;;
+            esac
+        done < /proc/1/cgroup
+    fi
+}
+'''
+
+FUNCTIONS = {
+    '__qb_scratch_dir': SCRATCH_DIR_SETUP,
+    '__qb_git_probe': GIT_PROBE,
+    '__qb_git_status': GIT_STATUS_FUNCTIONS,
+    '__qb_jobs_count': JOBS_COUNT_FUNCTION,
+    '__qb_command_time': COMMAND_TIME_PROBE,
+    '__qb_command_duration': COMMAND_DURATION_FUNCTION,
+    '__qb_kube_context': KUBE_CONTEXT_PROBE,
+    '__qb_container_detect': CONTAINER_DETECT_FUNCTION
+}
+
+# Variables set by probes, which are carried back from widgets evaluated in a subshell
+PROBE_OUTPUTS = {
+    '__qb_git_probe': ['QB_GIT_ROOT', 'QB_GIT_GITDIR', 'QB_GIT_HEAD', 'GIT_BRANCH'],
+    '__qb_command_time': ['COMMAND_TIME', 'QB_COMMAND_TS'],
+    '__qb_kube_context': ['KUBE_CONTEXT', 'QB_KUBE_SIGNATURE']
+}
+
+
+# -- Cost model ------------------------------------------------------------------------------------
+# Rough static estimation of processes spawned by generated shell code: every external command is a
+# subprocess, every command substitution, subshell group, background job or builtin pipeline stage
+# is a subshell (forked copy of bash). The shell code is tokenized just enough to tell those apart.
+SHELL_BUILTINS = set('''
+    . : [ alias bg bind break builtin caller cd command compgen complete compopt continue declare
+    dirs disown echo enable eval exec exit export false fc fg getopts hash help history jobs kill
+    let local logout mapfile popd printf pushd pwd read readarray readonly return set shift shopt
+    source suspend test times trap true type typeset ulimit umask unalias unset wait
+'''.split())
+SHELL_KEYWORDS = set('! { } if then else elif fi do done while until for case esac in select time'.split())
+
+class Cost:
+    def __init__(self, subprocesses = 0, subshells = 0, pipelines = 0):
+        self.subprocesses = subprocesses
+        self.subshells = subshells
+        self.pipelines = pipelines
+
+    def __add__(self, other):
+        return Cost(self.subprocesses + other.subprocesses, self.subshells + other.subshells,
+                    self.pipelines + other.pipelines)
+
+    @property
+    def forks(self): return self.subprocesses + self.subshells
+
+def find_closing(code, pos, opening, closing):
+    # Position of bracket closing the one right before pos, skipping quoted text
+    depth = 1
+    while pos < len(code):
+        char = code[pos]
+        if char == '\\':
+            pos += 1
+        elif char == "'" and opening not in '{"':
+            pos = code.find("'", pos + 1)
+            if pos < 0: break
+        elif char == '"':
+            pos = find_closing(code, pos + 1, '"', '"') if opening != '"' else pos
+            if opening == '"': return pos
+        elif char == opening:
+            depth += 1
+        elif char == closing:
+            depth -= 1
+            if depth == 0: return pos
+        pos += 1
+    return len(code)
+
+def tokenize_shell(code):
+    # Splits code to ('word', text) and ('op', text) tokens. Command and process substitutions are
+    # collected aside as (body, is_deferred) pairs, deferred ones being escaped with backslash, so
+    # that they are evaluated later, when resulting string is expanded again (e.g. as a prompt)
+    tokens = []
+    substitutions = []
+    word = ''
+    pos = 0
+    quoted = False
+    def flush():
+        nonlocal word
+        if word:
+            tokens.append(('word', word))
+            word = ''
+    while pos < len(code):
+        char = code[pos]
+        rest = code[pos:pos + 3]
+        if char == '\\' and code[pos + 1:pos + 3] == '$(' and code[pos + 3:pos + 4] != '(':
+            end = find_closing(code, pos + 3, '(', ')')
+            substitutions.append((code[pos + 3:end], True))
+            word += 'X'
+            pos = end
+        elif char == '\\':
+            word += code[pos:pos + 2]
+            pos += 1
+        elif rest[:3] == '$((':
+            end = find_closing(code, pos + 3, '(', ')')
+            substitutions += tokenize_shell(code[pos + 3:end])[1]
+            word += code[pos:end + 2]
+            pos = end + 1
+        elif rest[:2] in ['$(', '<(', '>('] and (rest[0] == '$' or not word):
+            end = find_closing(code, pos + 2, '(', ')')
+            substitutions.append((code[pos + 2:end], False))
+            word += 'X'
+            pos = end
+        elif rest[:2] == '${':
+            end = find_closing(code, pos + 2, '{', '}')
+            substitutions += tokenize_shell(code[pos + 2:end])[1]
+            word += code[pos:end + 1]
+            pos = end
+        elif char == '`':
+            end = code.find('`', pos + 1)
+            end = len(code) if end < 0 else end
+            substitutions.append((code[pos + 1:end], False))
+            word += 'X'
+            pos = end
+        elif quoted:
+            if char == '"': quoted = False
+            word += char
+        elif char == '"':
+            quoted = True
+            word += char
+        elif char == "'":
+            end = code.find("'", pos + 1)
+            end = len(code) if end < 0 else end
+            word += code[pos:end + 1]
+            pos = end
+        elif char == '#' and not word:
+            pos = code.find('\n', pos)
+            if pos < 0: break
+            continue
+        elif char in ' \t':
+            flush()
+            if tokens and tokens[-1] == ('word', '[['):
+                # Conditional expressions may contain regex brackets and pipes, keep them whole
+                end = code.find(' ]]', pos)
+                end = len(code) if end < 0 else end
+                substitutions += tokenize_shell(code[pos:end].replace('(', ' ').replace('|', ' '))[1]
+                tokens.append(('word', ']]'))
+                pos = end + 3
+                continue
+        elif char in '\n;&|()<>':
+            flush()
+            op = re.match(r';;|&&|\|\||&>>?|>>|>&|<<<|<&|\n|[;&|()<>]', code[pos:]).group(0)
+            tokens.append(('op', op))
+            pos += len(op)
+            continue
+        else:
+            word += char
+        pos += 1
+    flush()
+    return tokens, substitutions
+
+REDIRECTIONS = ['<', '>', '>>', '&>', '&>>', '>&', '<&', '<<<']
+
+def is_simple_command(tokens):
+    return all(kind == 'word' or text in REDIRECTIONS for kind, text in tokens)
+
+def parse_function_definitions(code):
+    return dict(re.findall(r'^(\w+)\(\) \{\n(.*?)\n\}', code, flags = re.M | re.S))
+
+def estimate_function_cost(name, seen = ()):
+    definitions = {}
+    for function in FUNCTIONS.values():
+        definitions.update(parse_function_definitions(function))
+    if name in seen or name not in definitions:
+        return Cost()
+    return estimate_cost(definitions[name], seen + (name,))[0]
+
+def estimate_login_cost(name):
+    # Code outside of function definitions is run once, when the script is loaded
+    code = re.sub(r'^\w+\(\) \{\n.*?\n\}', '', FUNCTIONS[name], flags = re.M | re.S)
+    return estimate_cost(code)[0]
+
+def estimate_stage_cost(words, seen):
+    # Returns cost of a single command and whether it is an external one
+    words = [word for word in words if not re.match(r'\w+\+?=', word)]
+    while words and words[0] in SHELL_KEYWORDS:
+        if words[0] in ['case', 'for', 'select']: return (Cost(), False)
+        words = words[1:]
+    if not words or words[0] in SHELL_BUILTINS or words[0] in ['[[', 'X']:
+        return (Cost(), False)
+    if words[0].startswith('__qb_'):
+        return (estimate_function_cost(words[0], seen), False)
+    return (Cost(subprocesses = 1), True)
+
+def estimate_cost(code, seen = ()):
+    # Returns (immediate, deferred) costs of given shell code
+    tokens, substitutions = tokenize_shell(code)
+    immediate = Cost()
+    deferred = Cost()
+    for body, is_deferred in substitutions:
+        inner = estimate_cost(body, seen)[0]
+        body_tokens = tokenize_shell(body)[0]
+        is_external = is_simple_command(body_tokens) and \
+                      estimate_stage_cost([text for kind, text in body_tokens], seen)[1]
+        # Bash executes single external command in place of the forked subshell
+        cost = inner + Cost(subshells = 0 if is_external else 1)
+        if is_deferred: deferred += cost
+        else: immediate += cost
+
+    stages = []
+    words = []
+    group = []
+    depth = 0
+    redirection = False
+    def finish_pipeline(background = False):
+        nonlocal stages, immediate
+        if words or group: stages.append((list(words), list(group)))
+        costs = []
+        for stage_words, stage_group in stages:
+            if stage_group:
+                cost = Cost() if background else estimate_cost(' '.join(stage_group), seen)[0]
+                costs.append((cost + Cost(subshells = 1), True))
+            elif background:
+                # Background job doesn't delay the prompt, only forking it does
+                costs.append((Cost(), estimate_stage_cost(stage_words, seen)[1]))
+            else:
+                costs.append(estimate_stage_cost(stage_words, seen))
+        if len(costs) > 1:
+            immediate += Cost(pipelines = 1)
+        for cost, is_forked in costs:
+            immediate += cost
+            if background and is_forked and not cost.forks:
+                immediate += Cost(subprocesses = 1)
+            elif (len(costs) > 1 or background) and not is_forked:
+                immediate += Cost(subshells = 1)
+        stages = []
+        words.clear()
+        group.clear()
+
+    for kind, text in tokens:
+        if depth > 0:
+            depth += {'(': 1, ')': -1}.get(text, 0) if kind == 'op' else 0
+            if depth > 0: group.append(text)
+        elif kind == 'word':
+            if not redirection: words.append(text)
+            redirection = False
+        elif text == '(' and not words:
+            depth = 1
+        elif text == ')':
+            words.clear()                       # case pattern
+        elif text == '|':
+            stages.append((list(words), list(group)))
+            words.clear()
+            group.clear()
+        elif text in ['\n', ';', ';;', '&&', '||', '&']:
+            finish_pipeline(text == '&')
+        elif text in REDIRECTIONS:
+            redirection = True
+    finish_pipeline()
+    return (immediate, deferred)
+
+def unescape_substitutions(code):
+    return code.replace('\\$(', '$(')
+
+def format_cost_report(rows, continuation_rows = []):
+    # Rows of lazily rendered prompts are paid only when continuation prompt is displayed, so they
+    # are totaled apart from the per prompt ones
+    def format_section(rows, title):
+        header = f' {"PS":<4} | {"Widget":<20} | {"Login: forks":>12} {"procs":>5} {"subsh":>5} {"pipes":>5} | '\
+                 f'{title + ": forks":>13} {"procs":>5} {"subsh":>5} {"pipes":>5}'
+        lines = [header, '-' * len(header)]
+        for ps_name, name, login, prompt in rows:
+            lines.append(f' {ps_name:<4} | {name:<20} | {login.forks:>12} {login.subprocesses:>5} '
+                         f'{login.subshells:>5} {login.pipelines:>5} | {prompt.forks:>13} '
+                         f'{prompt.subprocesses:>5} {prompt.subshells:>5} {prompt.pipelines:>5}')
+        login = sum((row[2] for row in rows), Cost())
+        prompt = sum((row[3] for row in rows), Cost())
+        lines.append('-' * len(header))
+        lines.append(f' {"":<4} | {"Total":<20} | {login.forks:>12} {login.subprocesses:>5} {login.subshells:>5} '
+                     f'{login.pipelines:>5} | {prompt.forks:>13} {prompt.subprocesses:>5} '
+                     f'{prompt.subshells:>5} {prompt.pipelines:>5}')
+        return lines
+    lines = format_section(rows, 'Prompt')
+    if continuation_rows:
+        lines += [''] + format_section(continuation_rows, 'Lazy')
+    return '\n'.join(lines)
+
+
 # -- Widget Classes --------------------------------------------------------------------------------
 class Widget:
+    functions = []
+    probes = []
+    # Shell code depending on terminal width only, which is run only when the width changes in
+    # layout mode
+    layout_code = []
+    # Shell expressions the widget output depends on, used for memoization. None means that
+    # output may change at any time, so it can't be memoized
+    dependencies = []
+
     def init(self, dct, is_right_aligned):
         # Read input parameters
         self.cfg = lambda: None
@@ -83,15 +1095,21 @@ class Widget:
         self.cfg.prefix = dct.get('prefix', DEFAULT_PREFIX)
         self.cfg.sufix = dct.get('sufix', DEFAULT_SUFIX)
         self.cfg.content = dct.get('content', DEFAULT_CONTENT)
+        self.cfg.timeout_ms = convert_number(dct.get('timeout_ms', 0))
+        self.cfg.cache_ttl = convert_number(dct.get('cache_ttl', 0))
+        self.cfg.cache_key = convert_cache_key(dct.get('cache_key', ''))
+        self.cfg.on_timeout = dct.get('on_timeout', 'last')
+        if self.cfg.on_timeout not in ['last', 'hide']:
+            self.cfg.on_timeout = None
         self.is_right_aligned = is_right_aligned
         
         # Define other fields
         self.static_length = len(self.cfg.term) + len(self.cfg.prefix) + len(self.cfg.sufix)
         self.printable = ''
-        self.pre_conditional_code = NULL_STRING
+        self.pre_conditional_code = ''
         self.condition_code = ':'
-        self.conditional_success_code = NULL_STRING
-        self.conditional_fail_code = NULL_STRING
+        self.conditional_success_code = ''
+        self.conditional_fail_code = ''
 
     def validate(self):
         for key, val in self.cfg.__dict__.items():
@@ -101,6 +1119,85 @@ class Widget:
     def __init__(self, dct, is_right_aligned):
         self.init(dct, is_right_aligned)
         self.validate()
+        if self.cfg.timeout_ms or self.cfg.cache_ttl or self.cfg.cache_key:
+            self.apply_evaluation_policy(dct)
+
+    def apply_evaluation_policy(self, dct):
+        # Widget is evaluated in prompt command, and its rendered content is stored in a variable,
+        # so that evaluation can be time-limited and cached no matter how the widget generates code
+        if self.is_static and self.dependencies is not None:
+            raise RuntimeError(f'{self.cfg.type}: Timeout and cache are supported only for widgets '
+                               'evaluated on every prompt')
+        generate_init_ir = self.generate_init_ir
+        generate_content_code = self.generate_content_code
+        # Several widgets of the same type may have different policies, so they need own variables
+        digest = hashlib.sha1(json.dumps([dct, self.is_right_aligned], sort_keys = True).encode())
+        self.policy_name = f'{self.cfg.type}_{digest.hexdigest()[:8]}'
+        self.is_static = False
+        self.dependencies = None
+        # Probes are run by the policy code too, so that they are time-limited and cached as well,
+        # instead of being run on every prompt before it
+        self.functions = self.probes + self.functions
+        self.policy_probes = self.probes
+        self.probes = []
+        self.generate_input_ir = lambda: None
+        self.generate_init_ir = lambda prev_transition, with_inputs = True: \
+            self.generate_policy_code(emit([generate_init_ir(prev_transition)]),
+                                      generate_content_code(prev_transition), prev_transition)
+        self.generate_content_code = lambda prev_transition: f'${{{self.policy_name}_RENDERED}}'
+
+    def generate_policy_code(self, init_code, content_code, prev_transition):
+        widget = self.cfg.type
+        name = self.policy_name
+        caching = self.cfg.cache_ttl or self.cfg.cache_key
+        # Rendered content depends on previous widget transition as well
+        cache_key = f'{self.cfg.cache_key}|{prev_transition}'
+        init_code = re.sub(f'^\\s*# {widget}\n', '', init_code)
+        code = ''.join(f'{probe}\n' for probe in self.policy_probes) + \
+               f'{init_code.strip()}\n{name}_RENDERED="{content_code}"\n'
+        store = f'{name}_CACHE_KEY="{cache_key}"\n{name}_CACHE_TS=${{EPOCHSECONDS}}' if caching else \
+                f'{name}_CACHE_TS=${{EPOCHSECONDS}}'
+
+        if self.cfg.timeout_ms:
+            # Evaluate in process substitution, and give up on reading its output after timeout. Late
+            # output is dropped with the pipe closed, so that stuck commands don't block the prompt
+            outputs = [f'{widget}_CONTENT', f'{widget}_TRANSITION', f'{widget}_LEN', f'{name}_RENDERED',
+                       *[output for probe in self.policy_probes for output in PROBE_OUTPUTS[probe]]]
+            outputs = ' '.join(f'{var} "${{{var}}}"' for var in outputs)
+            hide = f'{widget}_CONTENT=""\n{widget}_TRANSITION="{prev_transition}"\n{widget}_LEN=0\n'\
+                   f'{name}_RENDERED=""'
+            if self.cfg.on_timeout == 'last':
+                # Keep the last value, unless there is none yet
+                hide = f'if [ -z "${{{name}_CACHE_TS}}" ]; then\n{indent(hide, 4)}\nfi'
+            code = f'''
+                exec {{QB_WIDGET_FD}}< <(
+                    {indent(code, 20).strip()}
+                    printf "%s=%q\\n" {outputs} 2>/dev/null
+                )
+                read -r -d "" -t {self.cfg.timeout_ms / 1000:.3f} -u ${{QB_WIDGET_FD}} QB_WIDGET_OUTPUT
+                if [ $? -le 1 ]; then
+                    eval "${{QB_WIDGET_OUTPUT}}"
+                    {indent(store, 20).strip()}
+                else
+                    {indent(hide, 20).strip()}
+                fi
+                exec {{QB_WIDGET_FD}}<&-
+                '''
+            code = indent(code, -16)
+        else:
+            code += store + '\n'
+
+        if caching:
+            conditions = [f'[ "${{{name}_CACHE_KEY}}" != "{cache_key}" ]']
+            if self.cfg.cache_ttl:
+                conditions.append(f'[ $((EPOCHSECONDS - {name}_CACHE_TS)) -ge {self.cfg.cache_ttl} ]')
+            code = f'''
+                if {' || '.join(conditions)}; then
+                    {indent(code, 20).strip()}
+                fi
+                '''
+            code = indent(code, -16)
+        return Block(widget, [Code(code.strip())])
 
     def get_content(self, prev_transition):
         if self.is_right_aligned:
@@ -116,11 +1213,11 @@ class Widget:
     def get_printable_length_definitions(self):
         printable_length = self.get_printable_length()
         if self.is_right_aligned and not isinstance(printable_length, int):
-            length_definition_visible = f'{self.cfg.type}_LEN="{self.get_printable_length()}"'
-            length_definition_hidden = f'{self.cfg.type}_LEN=0'
+            length_definition_visible = Assign(f'{self.cfg.type}_LEN', printable_length)
+            length_definition_hidden = Assign(f'{self.cfg.type}_LEN', 0)
             return (length_definition_visible, length_definition_hidden)
         else:
-            return (NULL_STRING, NULL_STRING)
+            return (None, None)
 
 
     def generate_printable_length_code(self): return f'${{{self.cfg.type}_LEN}}'
@@ -129,24 +1226,28 @@ class Widget:
 
     def generate_content_code(self, prev_transition): return f'${{{self.cfg.type}_CONTENT}}'
 
-    def generate_init_code(self, prev_transition):
+    def generate_input_ir(self):
+        return Block(self.cfg.type, parse_code(self.pre_conditional_code))
+
+    def generate_init_ir(self, prev_transition, with_inputs = True):
         length_definition_visible, length_definition_hidden = self.get_printable_length_definitions()
-        code = f'''
-            # {self.cfg.type}
-            {self.pre_conditional_code}
-            if {self.condition_code}; then
-                {self.conditional_success_code}
-                {self.cfg.type}_CONTENT="{self.get_content(prev_transition)}"
-                {self.cfg.type}_TRANSITION="{F_FG}{self.cfg.bg}\]{self.cfg.term}\["
-                {length_definition_visible}
-            else
-                {self.conditional_fail_code}
-                {self.cfg.type}_CONTENT=""
-                {self.cfg.type}_TRANSITION="{prev_transition}"
-                {length_definition_hidden}
-            fi
-            '''
-        return indent(code, -12)
+        return Block(self.cfg.type, [
+            *(parse_code(self.pre_conditional_code) if with_inputs else []),
+            If(self.condition_code, [
+                Code(self.conditional_success_code),
+                Assign(f'{self.cfg.type}_CONTENT', self.get_content(prev_transition)),
+                Assign(f'{self.cfg.type}_TRANSITION', f'{F_FG}{self.cfg.bg}\]{self.cfg.term}\['),
+                length_definition_visible
+            ], [
+                Code(self.conditional_fail_code),
+                Assign(f'{self.cfg.type}_CONTENT', ''),
+                Assign(f'{self.cfg.type}_TRANSITION', prev_transition),
+                length_definition_hidden
+            ])
+        ])
+
+    def generate_init_code(self, prev_transition, with_inputs = True):
+        return emit([self.generate_init_ir(prev_transition, with_inputs)]) + '\n'
 
 class StaticWidget(Widget): is_static = True
 
@@ -168,12 +1269,42 @@ class WgSshAddress(StaticWidget):
     def init(self, dct, is_right_aligned):
         super().init(dct, is_right_aligned)
         self.printable = f'{self.cfg.prefix}${{SSH_ADDRESS}}{self.cfg.sufix}'
-        self.pre_conditional_code = 'SSH_ADDRESS=$(echo "${SSH_CONNECTION}" | sed -r "s/\S+ \S+ (\S+) \S+/\\1/")'
+        # SSH_CONNECTION is "<client address> <client port> <server address> <server port>"
+        self.pre_conditional_code = 'SSH_ADDRESS="${SSH_CONNECTION#* * }"; SSH_ADDRESS="${SSH_ADDRESS%% *}"'
         self.condition_code = '[ -n "${SSH_ADDRESS}" ]'
 
     def get_printable_length(self): return f'$((${{#SSH_ADDRESS}} + {self.static_length}))'
 
 
+# ------ WgHostname --------------------------------------------------------------------------------
+class WgHostname(StaticWidget):
+    def init(self, dct, is_right_aligned):
+        super().init(dct, is_right_aligned)
+        # Same as "\h" prompt escape, but its length is known for right alignment
+        self.printable = f'{self.cfg.prefix}${{HOST_NAME}}{self.cfg.sufix}'
+        self.pre_conditional_code = 'HOST_NAME="${HOSTNAME%%.*}"'
+
+    def get_printable_length(self): return f'$((${{#HOST_NAME}} + {self.static_length}))'
+
+
+# ------ WgContainer -------------------------------------------------------------------------------
+class WgContainer(StaticWidget):
+    functions = ['__qb_container_detect']
+
+    def init(self, dct, is_right_aligned):
+        super().init(dct, is_right_aligned)
+        # Static content replaces container runtime name, if given
+        self.printable = self.cfg.prefix + (self.cfg.content or '${CONTAINER}') + self.cfg.sufix
+        self.pre_conditional_code = '__qb_container_detect'
+        self.condition_code = '[ -n "${CONTAINER}" ]'
+
+    def get_printable_length(self):
+        # Static length is still defined as variable, which is zero while the widget is hidden
+        if self.cfg.content:
+            return str(super().get_printable_length())
+        return f'$((${{#CONTAINER}} + {self.static_length}))'
+
+
 # ------ WgUserMarker ------------------------------------------------------------------------------
 class WgUserMarker(StaticWidget):
     def init(self, dct, is_right_aligned):
@@ -200,19 +1331,17 @@ class WgUserMarker(StaticWidget):
 
     def generate_content_code(self, prev_transition): return self.get_content(prev_transition)
 
-    def generate_init_code(self, prev_transition):
-        code = f'''
-            # {self.cfg.type}
-            if [ ${{UID}} -eq 0 ]; then
-                USER_BG="{self.cfg.root_bg}"
-                USER_FG="{self.cfg.root_fg}"
-            else
-                USER_BG="{self.cfg.bg}"
-                USER_FG="{self.cfg.fg}"
-            fi
-            {self.get_printable_length_definitions()[0]}
-            '''
-        return indent(code, -12)
+    def generate_init_ir(self, prev_transition, with_inputs = True):
+        return Block(self.cfg.type, [
+            If('[ ${UID} -eq 0 ]', [
+                Assign('USER_BG', self.cfg.root_bg),
+                Assign('USER_FG', self.cfg.root_fg)
+            ], [
+                Assign('USER_BG', self.cfg.bg),
+                Assign('USER_FG', self.cfg.fg)
+            ]),
+            self.get_printable_length_definitions()[0]
+        ])
 
 
 # ------ WgUserName --------------------------------------------------------------------------------
@@ -232,6 +1361,9 @@ class WgCustom(StaticWidget):
         super().init(dct, is_right_aligned)
         self.printable = self.cfg.prefix + self.cfg.content + self.cfg.sufix
         self.cfg.length = dct.get('length', len(self.printable))
+        # Unescaped expansions and substitutions are evaluated on every PS assignment
+        if re.search(r'(?<!\\)[$`]', self.printable):
+            self.dependencies = None
 
     def get_printable_length(self): 
         if isinstance(self.cfg.length, int):
@@ -253,23 +1385,34 @@ class WgCustom(StaticWidget):
         else:
             return self.get_content(prev_transition)
 
-    def generate_init_code(self, prev_transition):
-        return self.get_printable_length_definitions()[0] + '\n'
+    def generate_init_ir(self, prev_transition, with_inputs = True):
+        return Block(None, [self.get_printable_length_definitions()[0]])
 
 
 # ------ WgCurrentDir ------------------------------------------------------------------------------
 class WgCurrentDir(DynamicWidget):
     # TODO: Invent smarter shortening algorithm
+    layout_code = ['STEP=$((${COLUMNS}/8))']
+
     def init(self, dct, is_right_aligned):
         super().init(dct, is_right_aligned)
         self.cfg.separator_fg = convert_color(dct.get('secondary_fg', DEFAULT_FG_COLOR))
         self.cfg.separator = dct.get('separator', '/')
+        self.cfg.mode = dct.get('mode', 'sed')
+        if self.cfg.mode not in ['sed', 'builtin']:
+            self.cfg.mode = None
+        self.dependencies = ['${PWD}', '${COLUMNS}']
 
     def get_printable_length(self): return 0
 
     def generate_transition_code(self): return f'{F_FG}{self.cfg.bg}\]{self.cfg.term}\['
 
     def generate_content_code(self, prev_transition):
+        if self.cfg.mode == 'builtin':
+            self.cfg.content = '${CURRENT_DIR}'
+            self.printable = self.cfg.prefix + self.cfg.content + self.cfg.sufix
+            return self.get_content(prev_transition)
+
         sed_scripts = []
 
         sed_replace_home = 's|^${HOME}|~|'
@@ -289,27 +1432,106 @@ class WgCurrentDir(DynamicWidget):
         self.printable = self.cfg.prefix + self.cfg.content + self.cfg.sufix
         return f'{self.get_content(prev_transition)}'
 
-    def generate_init_code(self, prev_transition):
-        code = f'''
-            # {self.cfg.type}
-            STEP=$((${{COLUMNS}}/8))
-        '''
-        return indent(code, -12)
+    def generate_input_ir(self): return self.generate_init_ir('')
+
+    def generate_init_ir(self, prev_transition, with_inputs = True):
+        if not with_inputs:
+            return None
+        if self.cfg.mode == 'builtin':
+            return Block(self.cfg.type, [self.generate_builtin_init_ir()])
+        return Block(self.cfg.type, [Code(self.layout_code[0])])
+
+    def generate_builtin_init_ir(self):
+        # Same transformations as sed scripts above, but with parameter expansion only,
+        # and re-rendered only when PWD or terminal width changes
+        if self.cfg.separator != '/':
+            separator = f'\\[{F_FG}{self.cfg.separator_fg}\\]{self.cfg.separator}\\[{F_FG}{self.cfg.fg}\\]'
+            replace_separators = [Assign('CURRENT_DIR_SEPARATOR', separator), Code(indent('''
+                case "${CURRENT_DIR}" in
+                    /) ;;
+                    /*) CURRENT_DIR="/${CURRENT_DIR//\\//"${CURRENT_DIR_SEPARATOR}"}" ;;
+                    *) CURRENT_DIR="${CURRENT_DIR//\\//"${CURRENT_DIR_SEPARATOR}"}" ;;
+                esac''', -16).strip())]
+        else:
+            replace_separators = []
+        return If('[ "${PWD}:${COLUMNS}" != "${CURRENT_DIR_KEY}" ]', [
+            Assign('CURRENT_DIR_KEY', '${PWD}:${COLUMNS}'),
+            Code(self.layout_code[0]),
+            Assign('CURRENT_DIR', '${PWD}'),
+            If('[[ "${CURRENT_DIR}" == "${HOME}"* ]]', [Assign('CURRENT_DIR', '~${CURRENT_DIR#"${HOME}"}')]),
+            If('[[ "${CURRENT_DIR}" =~ ^(.{0,${STEP}}/)(.{${STEP},})(/.{${STEP},}$) ]]',
+               [Assign('CURRENT_DIR', '${BASH_REMATCH[1]}···${BASH_REMATCH[3]}')]),
+            *replace_separators
+        ])
 
 
 # ------ WgJobsNumber ------------------------------------------------------------------------------
 class WgJobsNumber(DynamicWidget):
+    functions = ['__qb_jobs_count']
+    dependencies = ['${JOBS_NUM}']
+
     def init(self, dct, is_right_aligned):
         super().init(dct, is_right_aligned)
+        self.cfg.filter = {'all': '', 'running': ' -r', 'stopped': ' -s'}.get(dct.get('filter', 'all'))
+        if self.cfg.filter:
+            self.functions = ['__qb_scratch_dir', '__qb_jobs_count']
         self.printable = f'{self.cfg.prefix}${{JOBS_NUM}}{self.cfg.sufix}'
-        self.pre_conditional_code = 'JOBS_NUM=$(jobs | wc -l)'
+        self.pre_conditional_code = f'__qb_jobs_count{self.cfg.filter}'
         self.condition_code = '[ ${JOBS_NUM} -gt 0 ]'
     
     def get_printable_length(self): return f'$((${{#JOBS_NUM}} + {self.static_length}))'
 
 
+# ------ WgCommandDuration -------------------------------------------------------------------------
+class WgCommandDuration(DynamicWidget):
+    functions = ['__qb_command_duration']
+    probes = ['__qb_command_time']
+    dependencies = ['${COMMAND_TIME}']
+
+    def init(self, dct, is_right_aligned):
+        super().init(dct, is_right_aligned)
+        self.cfg.threshold = convert_number(dct.get('threshold', 2000))
+        self.cfg.units = dct.get('units', 'auto')
+        if self.cfg.units not in ['auto', 'ms', 's', 'm', 'h']:
+            self.cfg.units = None
+        self.printable = f'{self.cfg.prefix}${{COMMAND_DURATION}}{self.cfg.sufix}'
+        self.condition_code = f'[ ${{COMMAND_TIME}} -ge {self.cfg.threshold} ]'
+        self.conditional_success_code = f'__qb_command_duration {self.cfg.units}'
+
+    def get_printable_length(self): return f'$((${{#COMMAND_DURATION}} + {self.static_length}))'
+
+
+# ------ WgVirtualenv ------------------------------------------------------------------------------
+class WgVirtualenv(DynamicWidget):
+    dependencies = ['${VIRTUAL_ENV}']
+
+    def init(self, dct, is_right_aligned):
+        super().init(dct, is_right_aligned)
+        self.printable = f'{self.cfg.prefix}${{VIRTUAL_ENV_NAME}}{self.cfg.sufix}'
+        self.pre_conditional_code = 'VIRTUAL_ENV_NAME="${VIRTUAL_ENV##*/}"'
+        self.condition_code = '[ -n "${VIRTUAL_ENV_NAME}" ]'
+
+    def get_printable_length(self): return f'$((${{#VIRTUAL_ENV_NAME}} + {self.static_length}))'
+
+
+# ------ WgKubeContext -----------------------------------------------------------------------------
+class WgKubeContext(DynamicWidget):
+    functions = ['__qb_scratch_dir']
+    probes = ['__qb_kube_context']
+    dependencies = ['${KUBE_CONTEXT}']
+
+    def init(self, dct, is_right_aligned):
+        super().init(dct, is_right_aligned)
+        self.printable = f'{self.cfg.prefix}${{KUBE_CONTEXT}}{self.cfg.sufix}'
+        self.condition_code = '[ -n "${KUBE_CONTEXT}" ]'
+
+    def get_printable_length(self): return f'$((${{#KUBE_CONTEXT}} + {self.static_length}))'
+
+
 # ------ WgErrorCode -------------------------------------------------------------------------------
 class WgErrorCode(DynamicWidget):
+    dependencies = ['${ERR_CODE}']
+
     def init(self, dct, is_right_aligned):
         super().init(dct, is_right_aligned)
         self.printable = f'{self.cfg.prefix}${{ERR_CODE}}{self.cfg.sufix}'
@@ -318,31 +1540,96 @@ class WgErrorCode(DynamicWidget):
     def get_printable_length(self): return f'$((${{#ERR_CODE}} + {self.static_length}))'
 
 
+# ------ WgXtraceLocation --------------------------------------------------------------------------
+class WgXtraceLocation(StaticWidget):
+    def init(self, dct, is_right_aligned):
+        super().init(dct, is_right_aligned)
+        if is_right_aligned:
+            raise RuntimeError(f'{self.cfg.type}: Only left alignment is supported')
+        # Escaped expansions are kept in the prompt, and evaluated whenever it is displayed
+        self.printable = f'{self.cfg.prefix}\\${{BASH_SOURCE##*/}}:\\${{LINENO}}{self.cfg.sufix}'
+
+
+# ------ WgXtraceTime ------------------------------------------------------------------------------
+class WgXtraceTime(StaticWidget):
+    def init(self, dct, is_right_aligned):
+        super().init(dct, is_right_aligned)
+        if is_right_aligned:
+            raise RuntimeError(f'{self.cfg.type}: Only left alignment is supported')
+        # Microseconds since the prompt was displayed last time, i.e. since the previous traced
+        # command. Arithmetic expansion stores the timestamp without forking, the first delta is 0
+        delta = '\\$((QB_XTRACE_NOW=\\${EPOCHREALTIME/[.,]/}, '\
+                'QB_XTRACE_DELTA=QB_XTRACE_NOW-\\${QB_XTRACE_TS:-QB_XTRACE_NOW}, '\
+                'QB_XTRACE_TS=QB_XTRACE_NOW, QB_XTRACE_DELTA))'
+        self.printable = f'{self.cfg.prefix}{delta}us{self.cfg.sufix}'
+
+
 # ------ WgGitBranch -------------------------------------------------------------------------------
 class WgGitBranch(DynamicWidget):
+    probes = ['__qb_git_probe']
+    dependencies = ['${QB_GIT_ROOT}', '${GIT_BRANCH}']
+
     def init(self, dct, is_right_aligned):
         super().init(dct, is_right_aligned)
         self.printable = f'{self.cfg.prefix}${{GIT_BRANCH}}{self.cfg.sufix}'
-        self.pre_conditional_code = 'GIT_BRANCH_CMD=$(git branch 2> /dev/null)'
-        self.conditional_success_code = 'GIT_BRANCH=$(echo "${GIT_BRANCH_CMD}" | sed -rn "/^\*/s/\* (\S+)/\\1/p")'
-        self.condition_code = '[ $? -eq 0 ]'
+        self.condition_code = '[ -n "${QB_GIT_ROOT}" ]'
 
     def get_printable_length(self): return f'$((${{#GIT_BRANCH}} + {self.static_length}))'
 
 
+# ------ WgGitStatus -------------------------------------------------------------------------------
+class WgGitStatus(DynamicWidget):
+    functions = ['__qb_scratch_dir', '__qb_git_status']
+    probes = ['__qb_git_probe']
+    dependencies = ['${GIT_STATUS}']
+
+    def init(self, dct, is_right_aligned):
+        super().init(dct, is_right_aligned)
+        self.cfg.refresh = convert_number(dct.get('refresh', 5))
+        self.cfg.max_stale = convert_number(dct.get('max_stale', 300))
+        self.cfg.stale_marker = dct.get('stale_marker', '…')
+        self.printable = f'{self.cfg.prefix}${{GIT_STATUS}}{self.cfg.sufix}'
+        self.pre_conditional_code = f'__qb_git_status {self.cfg.refresh} {self.cfg.max_stale} '\
+                                    f'"{self.cfg.stale_marker}"'
+        self.condition_code = '[ -n "${GIT_STATUS}" ]'
+
+    def get_printable_length(self): return f'$((${{#GIT_STATUS}} + {self.static_length}))'
+
+
 # ------ WgGitMarker -------------------------------------------------------------------------------
 class WgGitMarker(DynamicWidget):
+    probes = ['__qb_git_probe']
+    dependencies = ['${QB_GIT_ROOT}']
+
     def init(self, dct, is_right_aligned):
         super().init(dct, is_right_aligned)
         self.printable = self.cfg.prefix + self.cfg.content + self.cfg.sufix
-        self.condition_code = 'git branch &> /dev/null'
+        self.condition_code = '[ -n "${QB_GIT_ROOT}" ]'
 
     def gen_printable_length_code(self): return self.get_printable_length()
 
 
 
 # -- Prompt ----------------------------------------------------------------------------------------
-def create_widget(dct, is_right_aligned):
+def cache_fragments(widget):
+    # Memoize code generators, so that widget reused from cache doesn't regenerate its fragments
+    for name in ['generate_input_ir', 'generate_init_ir', 'generate_init_code', 'generate_content_code']:
+        fragments = {}
+        def generate_fragment(*args, generate = getattr(widget, name), fragments = fragments):
+            if args not in fragments: fragments[args] = generate(*args)
+            return fragments[args]
+        setattr(widget, name, generate_fragment)
+    return widget
+
+def create_widget(dct, is_right_aligned, widget_cache = None):
+    # Widgets with unchanged json description are reused from widget_cache if it is given
+    if widget_cache is not None:
+        key = (json.dumps(dct, sort_keys = True), is_right_aligned)
+        if key not in widget_cache:
+            widget_cache[key] = cache_fragments(create_widget(dct, is_right_aligned))
+        return widget_cache[key]
+
+
     # Widget types definitions
     widgets_dict = {
         'WG_SSH_MARKER': WgSshMarker,
@@ -353,7 +1640,15 @@ def create_widget(dct, is_right_aligned):
         'WG_CURRENT_DIR': WgCurrentDir,
         'WG_JOBS_NUMBER': WgJobsNumber,
         'WG_ERROR_CODE': WgErrorCode,
+        'WG_COMMAND_DURATION': WgCommandDuration,
+        'WG_XTRACE_LOCATION': WgXtraceLocation,
+        'WG_XTRACE_TIME': WgXtraceTime,
+        'WG_VIRTUALENV': WgVirtualenv,
+        'WG_KUBE_CONTEXT': WgKubeContext,
+        'WG_HOSTNAME': WgHostname,
+        'WG_CONTAINER': WgContainer,
         'WG_GIT_BRANCH': WgGitBranch,
+        'WG_GIT_STATUS': WgGitStatus,
         'WG_GIT_MARKER': WgGitMarker
     }
 
@@ -368,43 +1663,170 @@ def create_widget(dct, is_right_aligned):
 
 class Prompt:
 
-    def __init__(self, name, dct):
+    def __init__(self, name, dct, widget_cache = None):
         self.name = name
-        self.left = [create_widget(wg_dct, False) for wg_dct in dct.get('left', [])]
-        self.right = [create_widget(wg_dct, True) for wg_dct in dct.get('right', [])]
+        self.left = [create_widget(wg_dct, False, widget_cache) for wg_dct in dct.get('left', [])]
+        self.right = [create_widget(wg_dct, True, widget_cache) for wg_dct in dct.get('right', [])]
 
     def static_only(self):
         return all(map(lambda x: x.is_static, self.left + self.right))
 
-    def generate_init_codes(self, right_aligned):
-        static_init_code = ''
-        dynamic_init_code = ''
+    def get_functions(self):
+        return [function for widget in self.left + self.right
+                for function in widget.probes + widget.functions]
+
+    def get_probes(self):
+        return [probe for widget in self.left + self.right for probe in widget.probes]
+
+    def get_layout_code(self):
+        return [code for widget in self.left + self.right for code in widget.layout_code]
+
+    def estimate_costs(self):
+        rows = []
+        static_only = self.static_only()
+        for widgets in [self.left, self.right]:
+            last_transition = ''
+            for widget in widgets:
+                init = estimate_cost(widget.generate_init_code(last_transition))
+                content = estimate_cost(f'{self.name}="{widget.generate_content_code(last_transition)}"')
+                login = Cost()
+                prompt = init[1] + content[1]
+                if widget.is_static: login += init[0]
+                else: prompt += init[0]
+                if static_only: login += content[0]
+                else: prompt += content[0]
+                rows.append((self.name, widget.cfg.type, login, prompt))
+                last_transition = widget.generate_transition_code()
+        return rows
+
+    def generate_init_irs(self, right_aligned, benchmarking = False):
+        static_init_ir = []
+        dynamic_init_ir = []
         last_transition = ''
         widgets = self.right if right_aligned else self.left
         for widget in widgets:
+            statement = widget.generate_init_ir(last_transition)
+            if benchmarking and statement and not statement.is_empty():
+                statement = profile([statement], widget.cfg.type, 'login' if widget.is_static else 'prompt')
             if widget.is_static:
-                static_init_code += widget.generate_init_code(last_transition)
+                static_init_ir.append(statement)
             else:
-                dynamic_init_code += widget.generate_init_code(last_transition)
+                dynamic_init_ir.append(statement)
             last_transition = widget.generate_transition_code()
-        return (static_init_code, dynamic_init_code)
+        return (filter_statements(static_init_ir), filter_statements(dynamic_init_ir))
+
+    def measure_bytes(self):
+        # Bytes of prompt with all widgets shown, before and after escape sequences minimization.
+        # Widget variables carrying escape sequences are expanded, other expansions are counted as is
+        values = {}
+        for widgets in [self.left, self.right]:
+            last_transition = ''
+            for widget in widgets:
+                for statement in walk([widget.generate_init_ir(last_transition)]):
+                    if isinstance(statement, If):
+                        values.update((assign.name, assign.value) for assign in statement.body
+                                      if isinstance(assign, Assign) and '\\e' in assign.value)
+                last_transition = widget.generate_transition_code()
+
+        def expand(code, minimize):
+            code = minimize_sgr(code) if minimize else code
+            for _ in range(len(values) + 1):
+                expanded = re.sub(r'\$\{(\w+)\}', lambda match: match.group(0) if match.group(1) not in values
+                                  else minimize_sgr(values[match.group(1)]) if minimize
+                                  else values[match.group(1)], code)
+                if expanded == code: break
+                code = expanded
+            return count_terminal_bytes(code)
+        content = self.generate_content_code()
+        return (self.name, expand(content, False), expand(content, True))
+
+    def get_dependencies(self, layout = False):
+        dependencies = []
+        for widget in self.left + self.right:
+            if widget.dependencies is None or \
+               any(dep in VOLATILE_DEPENDENCIES for dep in widget.dependencies):
+                return None
+            dependencies += [dep for dep in widget.dependencies if dep not in dependencies]
+        # Right prompt position doesn't depend on terminal width in layout mode
+        if self.right and not layout and '${COLUMNS}' not in dependencies:
+            dependencies.append('${COLUMNS}')
+        return dependencies
+
+    def generate_memoized_ir(self, prompt, benchmarking = False, layout = False):
+        # Inputs are computed on every prompt, while widgets and the prompt itself are
+        # re-rendered only when inputs fingerprint differs from the previous one
+        input_ir = []
+        render_ir = []
+        for widgets in [self.left, self.right]:
+            last_transition = ''
+            for widget in widgets:
+                if not widget.is_static:
+                    inputs = filter_statements([widget.generate_input_ir()])
+                    render = filter_statements([widget.generate_init_ir(last_transition, False)])
+                    if benchmarking and inputs:
+                        inputs = [profile(inputs, widget.cfg.type, 'input')]
+                    if benchmarking and render:
+                        render = [profile(render, widget.cfg.type, 'prompt')]
+                    input_ir += inputs
+                    render_ir += render
+                last_transition = widget.generate_transition_code()
+
+        dependencies = self.get_dependencies(layout)
+        if dependencies is None:
+            return input_ir + render_ir + [prompt]
+        fingerprint = '|'.join(dependencies)
+        return input_ir + [Block(None, [
+            Assign('QB_MEMO_KEY', fingerprint),
+            If(f'[ "${{QB_MEMO_KEY}}" != "${{QB_MEMO_{self.name}}}" ]', [
+                Assign(f'QB_MEMO_{self.name}', '${QB_MEMO_KEY}'),
+                Code('QB_MEMO_MISSES=$((QB_MEMO_MISSES + 1))'),
+                *render_ir,
+                prompt
+            ], [
+                Code('QB_MEMO_HITS=$((QB_MEMO_HITS + 1))')
+            ])
+        ])]
+
+    def get_profile_variables(self):
+        return [(widget, f'QB_PROFILE_{self.name}_{side}{index}')
+                for side, widgets in [('L', self.left), ('R', self.right)]
+                for index, widget in enumerate(widgets)]
+
+    def generate_widget_content_code(self, widget, prev_transition, profile_variable = None):
+        code = widget.generate_content_code(prev_transition)
+        if profile_variable:
+            # Empty substring expansions with arithmetic side effects measure content evaluation
+            # time without adding any printable characters
+            code = f'${{QB_PROFILE_NUL:$((QB_PROFILE_TS={EPOCH_US}))}}{code}'\
+                   f'${{QB_PROFILE_NUL:$(({profile_variable}={EPOCH_US} - QB_PROFILE_TS))}}'
+        return code
+
+    def generate_content_profile_code(self):
+        return ''.join(f'QB_PROFILE+=("{widget.cfg.type} render ${{{variable}}}")\n'
+                       for widget, variable in self.get_profile_variables())
 
-    def generate_content_code(self):
-        left_prompt = ''
+    def generate_content_code(self, benchmarking = False, layout = False):
+        # Prompt is collected as a list of fragments and joined once, right-aligned widgets
+        # are appended in reverse order, so that long prompts are built in linear time
+        profile_variables = dict((id(widget), variable) for widget, variable
+                                 in self.get_profile_variables()) if benchmarking else {}
+        left_prompt = []
         if len(self.left) > 0:
             last_transition = ''
             for widget in self.left:
-                left_prompt += widget.generate_content_code(last_transition)
+                left_prompt.append(self.generate_widget_content_code(widget, last_transition,
+                                                                     profile_variables.get(id(widget))))
                 last_transition = widget.generate_transition_code()
-            left_prompt += self.left[-1].generate_transition_code() + F_END
+            left_prompt += [self.left[-1].generate_transition_code(), F_END]
 
-        right_prompt = ''
+        right_prompt = []
         if len(self.right) > 0:
             last_transition = ''
             printable_lengths = []
             printable_length_num = 0
             for widget in self.right:
-                right_prompt = widget.generate_content_code(last_transition) + right_prompt
+                right_prompt.append(self.generate_widget_content_code(widget, last_transition,
+                                                                      profile_variables.get(id(widget))))
                 last_transition = widget.generate_transition_code()
                 printable_length = widget.generate_printable_length_code()
                 if isinstance(printable_length, int):
@@ -413,123 +1835,597 @@ class Prompt:
                     printable_lengths.append(printable_length)
             if printable_length_num > 0:
                 printable_lengths.append(str(printable_length_num))
-            printable_length = '-'.join(printable_lengths)
-            right_prompt = self.right[-1].generate_transition_code() + right_prompt
-            right_prompt = f'{F_SAVE_CURSOR}{F_MOVE_CURSOR_B}$((${{COLUMNS}}-{printable_length}))'\
-                           f'{F_MOVE_CURSOR_E}{right_prompt}{F_RESTORE_CURSOR}'
-        return f'\[{right_prompt}{left_prompt}\] '
+            if layout:
+                # Move to the right edge and back, so that terminal itself clamps the position, and
+                # the prompt redrawn after resize stays aligned. The last column is left empty
+                offset = f'$(({"+".join(printable_lengths)}))' if len(printable_lengths) > 1 else \
+                         (printable_lengths or ['0'])[0]
+                position = f'{F_MOVE_CURSOR_B}999{F_MOVE_CURSOR_E}'\
+                           f'{F_MOVE_CURSOR_B}{offset}{F_MOVE_CURSOR_BACK_E}'
+            else:
+                position = f'{F_MOVE_CURSOR_B}$((${{COLUMNS}}-{"-".join(printable_lengths)}))'\
+                           f'{F_MOVE_CURSOR_E}'
+            right_prompt = [F_SAVE_CURSOR, position, self.right[-1].generate_transition_code(),
+                            *reversed(right_prompt), F_RESTORE_CURSOR]
+        return ''.join(['\\[', *right_prompt, *left_prompt, '\\] '])
 
 
 # -- Prompts ---------------------------------------------------------------------------------------
 class Prompts:
-    def __init__(self, dct):
-        self.ps1 = Prompt('PS1', dct.get('PS1'))
-        self.ps2 = Prompt('PS2', dct.get('PS2'))
-        self.ps3 = Prompt('PS3', dct.get('PS3'))
-        self.ps4 = Prompt('PS4', dct.get('PS4'))
-
-    def generate(self, benchmarking = False):
-        static_code = ''
-        dynamic_code = ''
-        static_prompts = ''
-        dynamic_prompts = ''
+    def __init__(self, dct, widget_cache = None):
+        self.ps1 = Prompt('PS1', dct.get('PS1'), widget_cache)
+        self.ps2 = Prompt('PS2', dct.get('PS2'), widget_cache)
+        self.ps3 = Prompt('PS3', dct.get('PS3'), widget_cache)
+        self.ps4 = Prompt('PS4', dct.get('PS4'), widget_cache)
+
+    def get_probes(self):
+        probes = []
+        for ps in [self.ps1, self.ps2, self.ps3, self.ps4]:
+            for probe in ps.get_probes():
+                if probe not in probes: probes.append(probe)
+        return probes
+
+    def measure_bytes(self):
+        return [ps.measure_bytes() for ps in [self.ps1, self.ps2, self.ps3, self.ps4]]
+
+    def get_deferred(self, lazy):
+        # Continuation prompt is rarely displayed, so in lazy mode it is rendered by function called
+        # from the prompt itself, instead of on every prompt command. PS3 is never expanded by shell,
+        # and PS4 rendered this way would fork on every traced line, so they are not deferred
+        return [self.ps2] if lazy and not self.ps2.static_only() else []
+
+    def estimate_costs(self, lazy = False):
+        # Returns rows paid per prompt and rows paid per lazily rendered continuation prompt.
+        # Probes are called once per prompt, no matter how many widgets use them, shared functions
+        # set up at login are reported once as well
+        deferred = self.get_deferred(lazy)
+        functions = []
+        probes = []
+        for ps in [self.ps1, self.ps2, self.ps3, self.ps4]:
+            for function in ps.get_functions():
+                if function not in functions: functions.append(function)
+            for probe in ps.get_probes() if ps not in deferred else []:
+                if probe not in probes: probes.append(probe)
+        rows = [('', function, estimate_login_cost(function), Cost()) for function in functions
+                if estimate_login_cost(function).forks]
+        rows += [('', probe, Cost(), estimate_function_cost(probe)) for probe in probes]
+        continuation_rows = []
+        for ps in [self.ps1, self.ps2, self.ps3, self.ps4]:
+            if ps in deferred:
+                # Rendering function runs in command substitution subshell
+                continuation_rows += [(ps.name, f'__qb_render_{ps.name}', Cost(), Cost(subshells = 1))]
+                continuation_rows += [('', probe, Cost(), estimate_function_cost(probe))
+                                      for probe in ps.get_probes() if probe not in probes]
+                continuation_rows += ps.estimate_costs()
+            else:
+                rows += ps.estimate_costs()
+        return (rows, continuation_rows)
+
+    def generate(self, benchmarking = False, max_forks_per_prompt = None, memoize = False,
+                 zero_fork_login = False, bake = None, layout = False, lazy = False,
+                 fast_ps4 = False):
+        # Baked facts are environment variables known at generation time, e.g. {'UID': '1000'}
+        facts = bake or {}
+        unknown = [name for name in facts if name not in BAKEABLE_FACTS]
+        if unknown:
+            raise RuntimeError(f'Unsupported baked facts: {", ".join(unknown)}. '
+                               f'Supported: {", ".join(BAKEABLE_FACTS)}')
+        if not facts.get('UID', '0').isdigit():
+            raise RuntimeError(f'Invalid baked UID: "{facts["UID"]}"')
+        if facts.get('TERM', 'xterm-256color') != 'xterm-256color':
+            raise RuntimeError(f'Baked terminal "{facts["TERM"]}" does not support 8-bit colors')
+        if fast_ps4 and not self.ps4.static_only():
+            dynamic_widgets = [widget.cfg.type for widget in self.ps4.left + self.ps4.right
+                               if not widget.is_static]
+            raise RuntimeError('Fast PS4 is not possible, these widgets are evaluated in prompt command:' +
+                               ''.join(['\n - ' + widget for widget in dynamic_widgets]))
+        self.costs, self.continuation_costs = self.estimate_costs(lazy)
+        forking_widgets = [f'{row[0]} {row[1]} ({row[2].forks} forks)'.lstrip()
+                           for row in self.costs + self.continuation_costs if row[2].forks]
+        if zero_fork_login and forking_widgets:
+            raise RuntimeError('Zero-fork login is not possible, these widgets fork at login:' +
+                               ''.join(['\n - ' + widget for widget in forking_widgets]))
+        forks_per_prompt = sum(row[3].forks for row in self.costs)
+        if max_forks_per_prompt is not None and forks_per_prompt > max_forks_per_prompt:
+            raise RuntimeError(f'Estimated {forks_per_prompt} forks per prompt exceed the budget of '
+                               f'{max_forks_per_prompt}:\n{format_cost_report(self.costs, self.continuation_costs)}')
+
+        static_ir = []
+        dynamic_ir = []
+        static_prompts = []
+        dynamic_prompts = []
 
         if benchmarking:
-            dynamic_code += '\nexport QB_PROMPT_BENCH_TS=$(date +%s%N)\n'
-            bench_ps = '\$(echo \\" \$((\$(date +%s%N) - \${QB_PROMPT_BENCH_TS}))\\" | ' + \
-                       f'sed -r \\"s/.*(.{{2}})(.{{6}}$)/[\\1.\\2] /\\" | tee -a {PROFILING_INFO_FILE})'
-            bench_script_start = '\nSCRIPT_INIT_BENCH_TS=$(date +%s%N)\n\n'
-            bench_script_end = '\necho "Init time: $(($(date +%s%N) - ${SCRIPT_INIT_BENCH_TS}))" | ' + \
-                               f'sed -r "s/(.+)(.{{6}}$)/\\1.\\2 ms/" | tee -a {PROFILING_INFO_FILE}\n' 
+            # Records "<widget type> <phase> <microseconds>" are buffered in QB_PROFILE array and
+            # appended to profiling file in batches, so that profiling itself doesn't fork
+            dynamic_ir.append(Code(indent(f'''
+                QB_PROFILE_PROMPT_TS={EPOCH_US}
+                if [ -n "${{QB_PROFILE_RENDER}}" ]; then
+                    QB_PROFILE+=("TOTAL render ${{QB_PROFILE_RENDER}}")
+                    QB_PROFILE_RENDER=""
+                fi
+                ''', -16)))
+            bench_ps = f'\\${{QB_PROFILE_NUL:\\$((QB_PROFILE_RENDER=\\{EPOCH_US} - QB_PROFILE_PROMPT_TS))}}'
+            bench_script_start = indent(f'''
+                QB_PROFILE_LOGIN_TS={EPOCH_US}
+                QB_PROFILE=()
+                QB_PROFILE_NUL=""
+                __qb_profile_flush() {{
+                    printf "%s\\n" "${{QB_PROFILE[@]}}" >> "{PROFILING_INFO_FILE}"
+                    QB_PROFILE=()
+                }}
+                ''', -16).splitlines()[1:] + ['']
+            # Records buffered since the last flush are written on exit as well, after any existing
+            # EXIT trap. It is read back by command substitution only after login time is recorded
+            bench_script_end = indent(f'''
+                QB_PROFILE+=("TOTAL login $(({EPOCH_US} - QB_PROFILE_LOGIN_TS))")
+                __qb_profile_flush
+                __qb_profile_trap() {{
+                    eval "set -- $(trap -p EXIT)"
+                    [[ "$3" == *"__qb_profile_flush"* ]] || trap "${{3:+$3; }}__qb_profile_flush" EXIT
+                }}
+                __qb_profile_trap
+                ''', -16).splitlines()[1:]
+            bench_flush = Code(indent('''
+                if [ ${#QB_PROFILE[@]} -ge 64 ]; then
+                    __qb_profile_flush
+                fi
+                ''', -16))
         else:
-            bench_ps = bench_script_start = bench_script_end = ''
+            bench_ps = ''
+            bench_script_start = bench_script_end = []
+            bench_flush = None
 
+        functions = []
         for ps in [self.ps1, self.ps2, self.ps3, self.ps4]:
-            preconditions = ps.generate_init_codes(False)
-            static_code += preconditions[0]
-            dynamic_code += preconditions[1]
-            preconditions = ps.generate_init_codes(True)
-            static_code += preconditions[0]
-            dynamic_code += preconditions[1]
+            for function in ps.get_functions():
+                if function not in functions: functions.append(function)
+        static_ir += [Code(FUNCTIONS[function]) for function in functions]
+        deferred = self.get_deferred(lazy)
+        probes = []
+        for ps in [self.ps1, self.ps2, self.ps3, self.ps4]:
+            for probe in ps.get_probes() if ps not in deferred else []:
+                if probe not in probes: probes.append(probe)
+        if probes:
+            dynamic_ir.append(Block(None, [Code(probe) for probe in probes]))
+
+        layout_code = []
+        if layout:
+            for ps in [self.ps1, self.ps2, self.ps3, self.ps4]:
+                for code in ps.get_layout_code():
+                    if code not in layout_code: layout_code.append(code)
+        if layout_code:
+            # Terminal width is updated by checkwinsize after each command, so width-dependent code
+            # is hoisted out of widgets and run only when it changes
+            static_ir.append(Block(None, [Code('shopt -s checkwinsize')]))
+            dynamic_ir.append(Block('Terminal width', [If('[ "${COLUMNS}" != "${QB_LAYOUT_COLUMNS}" ]', [
+                Assign('QB_LAYOUT_COLUMNS', '${COLUMNS}'),
+                *[Code(code) for code in layout_code]
+            ])]))
+        hoist_layout = lambda statements: rebuild(statements, lambda statement: None if
+            isinstance(statement, Code) and statement.text in layout_code else statement)
+
+        if memoize:
+            static_ir.append(Block(None, [Code('QB_MEMO_HITS=0'), Code('QB_MEMO_MISSES=0')]))
+
+        for ps in [self.ps1, self.ps2, self.ps3, self.ps4]:
+            preconditions = ps.generate_init_irs(False, benchmarking)
+            preconditions_right = ps.generate_init_irs(True, benchmarking)
+            static_ir += preconditions[0] + preconditions_right[0]
 
             if ps is not self.ps1: bench_ps = ''
+            if ps in deferred:
+                # Function runs in command substitution subshell, so its variables don't leak, and
+                # it can't be profiled or memoized. Its output is the prompt with escapes decoded
+                render = f'__qb_render_{ps.name}'
+                static_ir.append(Block(None, [Function(render, [
+                    Assign('ERR_CODE', '$?'),
+                    *[Code(probe) for probe in ps.get_probes() if probe not in probes],
+                    *hoist_layout(ps.generate_init_irs(False)[1] + ps.generate_init_irs(True)[1]),
+                    Assign(ps.name, ps.generate_content_code(False, layout)),
+                    Code(f'printf "%s" "${{{ps.name}@P}}"')
+                ])]))
+                static_prompts.append(Assign(ps.name, f'\\$({render})'))
+                continue
+            # Static prompts are assigned once at login, so their content is not profiled per widget:
+            # its evaluation is already covered by login records of the widgets
+            profiling = benchmarking and not ps.static_only()
+            prompt = [Assign(ps.name, f'{ps.generate_content_code(profiling, layout)}{bench_ps}')]
+            if profiling: prompt.append(Code(ps.generate_content_profile_code()))
             if ps.static_only():
-                static_prompts += f'export {ps.name}="{ps.generate_content_code()}{bench_ps}"\n'
+                static_prompts += prompt
+            elif memoize:
+                memoized_ir = ps.generate_memoized_ir(Block(None, prompt), benchmarking, layout)
+                dynamic_ir += hoist_layout(memoized_ir)
             else:
-                dynamic_prompts += f'export {ps.name}="{ps.generate_content_code()}{bench_ps}"\n'
-
-        if static_prompts: static_code += '\n' + static_prompts
-        if dynamic_prompts: dynamic_code += '\n' + dynamic_prompts
-
-        if dynamic_code:
-            dynamic_code=f'''
-                export PROMPT_COMMAND='
-                    ERR_CODE=$?
-                    {indent(dynamic_code, 20)}
-                ' '''
-
-        code = f'''\
-            #!/bin/bash
-
-            # This file is generated automatically by qb-prompt/generate.py
-            # It is not recommended to edit it manually
-            {indent(bench_script_start, 12)}
-            # Apply only if terminal supports 8-bit colors 
-            if [ "${{TERM}}" != "xterm-256color" ]; then
-                echo "qb-prompt: terminal does not support 8-bit colors"
-            else
-                {indent(static_code, 16)}
-                {dynamic_code}
-            fi
-            {indent(bench_script_end,12)}
-            '''
+                dynamic_ir += hoist_layout(preconditions[1] + preconditions_right[1])
+                dynamic_prompts += prompt
+
+        # Prompts are shell variables only, there is no need to copy them to children environment
+        static_prompts = [Block(None, [Code('export -n PS1 PS2 PS3 PS4'), *static_prompts])]
+        dynamic_ir += filter_statements([Block(None, dynamic_prompts), bench_flush])
+
+        # Script is emitted as text only after optimization passes, prompts are protected from
+        # elimination because they are read by the shell itself
+        sections = optimize({'static': static_ir, 'prompts': static_prompts, 'dynamic': dynamic_ir},
+                            'static', ['PS1', 'PS2', 'PS3', 'PS4'], facts)
+        if fast_ps4:
+            # PS4 is expanded before every traced command, so any command substitution in it
+            # would fork on every line of xtrace output
+            substitutions = find_deferred_substitutions(sections, 'PS4')
+            if substitutions:
+                raise RuntimeError('Fast PS4 is not possible, it contains command substitutions:' +
+                                   ''.join(['\n - ' + substitution for substitution in substitutions]))
+        static_lines = emit(sections['static'] + sections['prompts']).splitlines()
+        dynamic_lines = emit(sections['dynamic']).splitlines()
+
+        if dynamic_lines:
+            # Function is parsed once, unlike PROMPT_COMMAND string. It runs before other prompt
+            # commands to get exit code of the last command, and passes it on to them
+            dynamic_lines = [
+                '',
+                '__qb_prompt_update() {',
+                '    ERR_CODE=$?',
+                *['    ' + line for line in dynamic_lines],
+                '    return ${ERR_CODE}',
+                '}',
+                'if [[ ";${PROMPT_COMMAND};" != *";__qb_prompt_update;"* ]]; then',
+                '    PROMPT_COMMAND="__qb_prompt_update${PROMPT_COMMAND:+;${PROMPT_COMMAND}}"',
+                'fi'
+            ]
+
+        # Independently sourceable parts of the script, used to build deltas for running shells
+        self.fragments = {
+            'static': [statement.emit() + '\n' for statement in sections['static']],
+            'prompts': emit(sections['prompts']) + '\n',
+            'prompt_command': '\n'.join(dynamic_lines)
+        }
+
+        # Script is collected as a list of lines, joined and cleaned up once
+        body = static_lines + dynamic_lines
+        if 'TERM' not in facts:
+            body = [
+                '# Apply only if terminal supports 8-bit colors',
+                'if [ "${TERM}" != "xterm-256color" ]; then',
+                '    echo "qb-prompt: terminal does not support 8-bit colors"',
+                'else',
+                *['    ' + line for line in body],
+                'fi'
+            ]
+        lines = [
+            '#!/bin/bash',
+            '',
+            '# This file is generated automatically by qb-prompt/generate.py',
+            '# It is not recommended to edit it manually',
+            '',
+            *bench_script_start,
+            *body,
+            '',
+            *bench_script_end,
+            ''
+        ]
+        return strip_trailing_spaces('\n'.join(lines))
+
+    def generate_delta(self, previous):
+        # Only sections changed since previous generation, plus static prompts, because they
+        # are expanded on assignment and might depend on changed static variables
+        current = self.fragments
+        changed = [section for section in current['static'] if section not in previous['static']]
+        if not changed and current['prompts'] == previous['prompts'] and \
+           current['prompt_command'] == previous['prompt_command']:
+            return ''
+        code = ''.join(changed) + current['prompts']
+        if current['prompt_command'] != previous['prompt_command']:
+            code += current['prompt_command'] or PROMPT_COMMAND_REMOVAL
+        return strip_trailing_spaces(f'#!/bin/bash\n\n# qb-prompt delta, source it from a running shell\n{code}\n')
+
+PROMPT_COMMAND_REMOVAL = '''
+unset -f __qb_prompt_update
+PROMPT_COMMAND="${PROMPT_COMMAND#__qb_prompt_update}"
+PROMPT_COMMAND="${PROMPT_COMMAND#;}"
+'''
+
+# -- Profiling -------------------------------------------------------------------------------------
+def percentile(values, pct):
+    # Nearest-rank method on sorted values
+    return values[max(0, -(-len(values) * pct // 100) - 1)]
+
+def summarize_profile(lines):
+    samples = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 3 and fields[2].isdigit():
+            samples.setdefault((fields[0], fields[1]), []).append(int(fields[2]))
+    summary = []
+    for (name, phase), values in sorted(samples.items()):
+        values.sort()
+        summary.append((name, phase, len(values), *[percentile(values, pct) for pct in [50, 95, 99]]))
+    return summary
+
+def format_profile_summary(summary):
+    lines = [f' {"Widget":<20} | {"Phase":<6} | {"Count":>6} | {"p50":>9} | {"p95":>9} | {"p99":>9}',
+             f'{"-"*22}|{"-"*8}|{"-"*8}|{"-"*11}|{"-"*11}|{"-"*11}']
+    for name, phase, count, *pcts in summary:
+        lines.append(f' {name:<20} | {phase:<6} | {count:>6} | ' +
+                     ' | '.join(f'{pct / 1000:>6.3f} ms' for pct in pcts))
+    lines.append('Render records cover prompts rendered in prompt command only, widgets of static '
+                 'prompts are measured at login')
+    return '\n'.join(lines)
+
+
+# -- API -------------------------------------------------------------------------------------------
+# Library interface for generating prompts without spawning the script, e.g.:
+#   import generate
+#   code = generate.generate_script({'PS1': {...}, 'PS2': {...}, 'PS3': {...}, 'PS4': {...}})
+def get_generator_version():
+    with open(__file__, 'rb') as file: return hashlib.sha256(file.read()).hexdigest()
+
+def parse_config(config):
+    return json.loads(re.sub(r'//.*', '', config))
+
+def load_config(config_file):
+    with open(config_file) as file: return parse_config(file.read())
+
+def generate_script(config, **options):
+    # Config is either parsed dict or path to json-formatted config file. Options are passed
+    # to Prompts.generate(): benchmarking, max_forks_per_prompt, memoize, zero_fork_login, bake, layout,
+    # lazy, fast_ps4
+    if not isinstance(config, dict):
+        config = load_config(config)
+    return Prompts(config).generate(**options)
+
+def write_file(path, content):
+    # Write to temporary file first and rename it, so that readers never see partial content
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'w') as file: file.write(content)
+        if os.path.exists(path): os.chmod(temp_path, os.stat(path).st_mode)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path): os.remove(temp_path)
+
+def generate_batch_item(config, output_file, options):
+    try:
+        code = generate_script(parse_config(config), **options)
+        write_file(output_file, code)
+    except (json.decoder.JSONDecodeError, RuntimeError, OSError) as error:
+        return str(error)
+    except Exception as error:
+        # Malformed configuration, e.g. a list where an object is expected, fails only its own entry
+        return f'Invalid configuration: {type(error).__name__}: {error}'
+
+def generate_batch(pairs, cache_file = DEFAULT_CACHE_FILE, jobs = None, **options):
+    # Generates (config_file, output_file) pairs in parallel. Outputs are skipped if they exist and
+    # the hash of their config content, generator version and options hasn't changed since the
+    # previous run. Returns {output_file: 'generated' | 'skipped' | error message}
+    version = get_generator_version()
+    try:
+        with open(cache_file) as file: cache = json.load(file)
+    except (OSError, json.decoder.JSONDecodeError):
+        cache = {}
+
+    results = {}
+    keys = {}
+    futures = {}
+    with ProcessPoolExecutor(jobs) as executor:
+        for config_file, output_file in pairs:
+            try:
+                with open(config_file) as file: config = file.read()
+            except OSError as error:
+                results[output_file] = f'Failed to read input file: {error}'
+                continue
+            key = hashlib.sha256(f'{version}\n{sorted(options.items())}\n{config}'.encode()).hexdigest()
+            if cache.get(output_file) == key and os.path.exists(output_file):
+                results[output_file] = 'skipped'
+            else:
+                keys[output_file] = key
+                futures[output_file] = executor.submit(generate_batch_item, config, output_file, options)
+        for output_file, future in futures.items():
+            try:
+                error = future.result()
+            except Exception as exception:
+                # Worker process crashed, e.g. killed or out of memory
+                error = f'Failed to generate prompt: {type(exception).__name__}: {exception}'
+            results[output_file] = error or 'generated'
+            if error:
+                cache.pop(output_file, None)
+            else:
+                cache[output_file] = keys[output_file]
+
+    # Parallel or interrupted runs must never leave a truncated cache behind
+    write_file(cache_file, json.dumps(cache, indent = 4))
+    return {output_file: results[output_file] for _, output_file in pairs}
+
+def watch(config_file, output_file, delta_file = None, interval = 0.5, **options):
+    # Polls config file and regenerates the output whenever it changes. Only widgets with changed
+    # json description are regenerated, the rest reuse cached fragments
+    widget_cache = {}
+    fragments = None
+    config_mtime = None
+    while True:
+        try:
+            mtime = os.stat(config_file).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != config_mtime:
+            config_mtime = mtime
+            cached_widgets = set(widget_cache)
+            try:
+                prompts = Prompts(load_config(config_file), widget_cache)
+                code = prompts.generate(**options)
+                write_file(output_file, code)
+                if delta_file and fragments is not None:
+                    write_file(delta_file, prompts.generate_delta(fragments))
+            except (OSError, json.decoder.JSONDecodeError, RuntimeError) as error:
+                print(f'Failed to generate prompt:\n{str(error)}')
+            else:
+                fragments = prompts.fragments
+                # Forget widgets which are no longer used
+                used_widgets = {key for key, widget in widget_cache.items()
+                                if any(widget in ps.left + ps.right
+                                       for ps in [prompts.ps1, prompts.ps2, prompts.ps3, prompts.ps4])}
+                for key in set(widget_cache) - used_widgets: del widget_cache[key]
+                print(f'{time.strftime("%H:%M:%S")} {output_file}: regenerated '
+                      f'{len(used_widgets - cached_widgets)} of {len(used_widgets)} widgets')
+        time.sleep(interval)
+
+def read_batch_file(batch_file):
+    # Each line is "<config_file> <output_file>", empty lines and #-comments are ignored
+    with open(batch_file) as file: lines = [re.sub('#.*', '', line).split() for line in file]
+    for line in lines:
+        if line and len(line) != 2:
+            raise RuntimeError(f'Invalid batch line: "{" ".join(line)}"')
+    return [tuple(line) for line in lines if line]
 
-        code = indent(code, -12)
-        code = re.sub(f'\n *{NULL_STRING}.*', '', code)
-        code = re.sub(' *$', '', code, flags = re.M)
-        return code
 
 ####################################################################################################
 # -- ENTRY POINT ----------------------------------------------------------------------------------#
 ####################################################################################################
 
-config_file = DEFAULT_CONFIG_FILE
-output_file = DEFAULT_OUTPUT_FILE
-benchmarking = False
-if len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help']:
-  print(HELP)
-  exit(0)
-if len(sys.argv) > 1 and sys.argv[1] != '-':
-  config_file = sys.argv[1]
-if len(sys.argv) > 2 and sys.argv[2] != '-':
-  output_file = sys.argv[2]
-if len(sys.argv) > 3 and sys.argv[3] in ['-b', '--benchmark']:
-    benchmarking = True
-
-# Read config
-try:
-    with open(config_file) as file: config = file.read()
-except FileNotFoundError: 
-    print(f'Iput file "{config_file}" not found')
-    exit(-1)
-except:
-    print("Failed to read input file:", sys.exc_info()[0])
-    exit(-1)
-
-# Parse config
-try:
-    prompts_json = json.loads(re.sub(r'//.*', '', config))
-    prompts = Prompts(prompts_json)
-except (json.decoder.JSONDecodeError, RuntimeError) as error:
-    print(f'Failed to parse input config:\n{str(error)}')
-    exit(-1)
-
-# Generate shell script
-code = prompts.generate(benchmarking)
-
-# Write generated script to output file
-try:
-    with open(output_file, 'w') as file: file.write(code)
-except:
-    print("Failed to write output file:", sys.exc_info()[0])
-    exit(-1)
+def main():
+    config_file = DEFAULT_CONFIG_FILE
+    output_file = DEFAULT_OUTPUT_FILE
+    benchmarking = False
+    if len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help']:
+      print(HELP)
+      exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'profile':
+        profile_file = sys.argv[2] if len(sys.argv) > 2 else PROFILING_INFO_FILE
+        try:
+            with open(profile_file) as file: print(format_profile_summary(summarize_profile(file)))
+        except OSError as error:
+            print(f'Failed to read profile file: {error}')
+            exit(-1)
+        exit(0)
+    print_costs = False
+    print_bytes = False
+    cache_file = DEFAULT_CACHE_FILE
+    jobs = None
+    watching = False
+    delta_file = None
+    memoize = False
+    zero_fork_login = False
+    max_forks_per_prompt = None
+    bake = {}
+    layout = False
+    lazy = False
+    fast_ps4 = False
+    positional_args = []
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg in ['-b', '--benchmark']:
+            benchmarking = True
+        elif arg in ['-c', '--costs']:
+            print_costs = True
+        elif arg == '--bytes':
+            print_bytes = True
+        elif arg in ['-m', '--memoize']:
+            memoize = True
+        elif arg == '--max-forks-per-prompt':
+            max_forks_per_prompt = next(args, '')
+            if not max_forks_per_prompt.isdigit():
+                print(f'Invalid forks budget: "{max_forks_per_prompt}"')
+                exit(-1)
+            max_forks_per_prompt = int(max_forks_per_prompt)
+        elif arg == '--zero-fork-login':
+            zero_fork_login = True
+        elif arg == '--layout':
+            layout = True
+        elif arg == '--lazy':
+            lazy = True
+        elif arg == '--fast-ps4':
+            fast_ps4 = True
+        elif arg == '--bake':
+            fact = next(args, '')
+            if '=' not in fact:
+                print(f'Invalid fact, expected NAME=VALUE: "{fact}"')
+                exit(-1)
+            name, value = fact.split('=', 1)
+            bake[name] = value
+        elif arg in ['-j', '--jobs']:
+            jobs = next(args, '')
+            if not jobs.isdigit() or int(jobs) == 0:
+                print(f'Invalid jobs number: "{jobs}"')
+                exit(-1)
+            jobs = int(jobs)
+        elif arg == '--cache':
+            cache_file = next(args, cache_file)
+        elif arg in ['-w', '--watch']:
+            watching = True
+        elif arg == '--delta':
+            delta_file = next(args, None)
+        elif arg.startswith('-') and arg != '-':
+            print(f'Unknown option: {arg}\n\n{HELP}')
+            exit(-1)
+        else:
+            positional_args.append(arg)
+    options = {'benchmarking': benchmarking, 'max_forks_per_prompt': max_forks_per_prompt,
+               'memoize': memoize, 'zero_fork_login': zero_fork_login,
+               'bake': dict(sorted(bake.items())), 'layout': layout, 'lazy': lazy,
+               'fast_ps4': fast_ps4}
+
+    # Generate batch of config->output pairs
+    if len(positional_args) > 0 and positional_args[0] == 'batch':
+        if len(positional_args) < 2:
+            print(f'Missing batch file\n\n{HELP}')
+            exit(-1)
+        try:
+            pairs = read_batch_file(positional_args[1])
+            results = generate_batch(pairs, cache_file, jobs, **options)
+        except (OSError, RuntimeError) as error:
+            print(f'Failed to run batch:\n{str(error)}')
+            exit(-1)
+        for output_file, result in results.items():
+            print(f'{output_file}: {result}')
+        exit(0 if all(result in ['generated', 'skipped'] for result in results.values()) else -1)
+
+    if len(positional_args) > 0 and positional_args[0] != '-':
+      config_file = positional_args[0]
+    if len(positional_args) > 1 and positional_args[1] != '-':
+      output_file = positional_args[1]
+
+    # Regenerate on every config change until interrupted
+    if watching:
+        try:
+            watch(config_file, output_file, delta_file, **options)
+        except KeyboardInterrupt:
+            exit(0)
+
+    # Read config
+    try:
+        with open(config_file) as file: config = file.read()
+    except FileNotFoundError: 
+        print(f'Iput file "{config_file}" not found')
+        exit(-1)
+    except:
+        print("Failed to read input file:", sys.exc_info()[0])
+        exit(-1)
+
+    # Parse config
+    try:
+        prompts = Prompts(parse_config(config))
+    except (json.decoder.JSONDecodeError, RuntimeError) as error:
+        print(f'Failed to parse input config:\n{str(error)}')
+        exit(-1)
+
+    # Generate shell script
+    try:
+        code = prompts.generate(**options)
+    except RuntimeError as error:
+        print(f'Failed to generate prompt:\n{str(error)}')
+        exit(-1)
+    if print_costs:
+        print(format_cost_report(prompts.costs, prompts.continuation_costs))
+    if print_bytes:
+        print(format_bytes_report(prompts.measure_bytes()))
+
+    # Write generated script to output file
+    try:
+        write_file(output_file, code)
+    except:
+        print("Failed to write output file:", sys.exc_info()[0])
+        exit(-1)
+
+
+if __name__ == '__main__':
+    main()
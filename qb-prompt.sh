@@ -8,6 +8,19 @@ if [ "${TERM}" != "xterm-256color" ]; then
     echo "qb-prompt: terminal does not support 8-bit colors"
 else
 
+    # Count background jobs without forking: \j prompt escape for all jobs, jobs builtin output
+    # redirected to per-shell scratch file for running (-r) or stopped (-s) ones only
+    __qb_jobs_count() {
+        local pids='\j'
+        JOBS_NUM="${pids@P}"
+        if [ -n "$1" ] && [ ${JOBS_NUM} -gt 0 ] && [ -n "${QB_SCRATCH_DIR}" ]; then
+            local file="${QB_SCRATCH_DIR}/jobs.$$"
+            jobs "$1" -p 2> /dev/null > "${file}" || return
+            mapfile -t pids < "${file}"
+            JOBS_NUM=${#pids[@]}
+        fi
+    }
+
     # WG_USER_MARKER
     if [ ${UID} -eq 0 ]; then
         USER_BG="8;5;130m"
@@ -17,20 +30,21 @@ else
         USER_FG="7m"
     fi
 
-    export PS2="\[\e[38;5;241m\]\[\e[0m\] "
-    export PS3="\[\e[38;5;241m\]\[\e[0m\] "
-    export PS4="\[\e[48;5;241m\e[39m\]+\[\e[0m\e[38;5;241m\]\[\e[0m\] "
+    export -n PS1 PS2 PS3 PS4
+    PS2="\[\e[38;5;241m\]\[\e[0m\] "
+    PS3="\[\e[38;5;241m\]\[\e[0m\] "
+    PS4="\[\e[48;5;241;39m\]+\[\e[0;38;5;241m\]\[\e[0m\] "
 
-    export PROMPT_COMMAND='
+    __qb_prompt_update() {
         ERR_CODE=$?
 
         # WG_CURRENT_DIR
         STEP=$((${COLUMNS}/8))
 
         # WG_JOBS_NUMBER
-        JOBS_NUM=$(jobs | wc -l)
+        __qb_jobs_count
         if [ ${JOBS_NUM} -gt 0 ]; then
-            WG_JOBS_NUMBER_CONTENT="\e[48;5;130m\e[38;5;241m\]\[\e[37m\] ${JOBS_NUM} \[\e[0m"
+            WG_JOBS_NUMBER_CONTENT="\e[48;5;130;38;5;241m\]\[\e[37m\] ${JOBS_NUM} \[\e[0m"
             WG_JOBS_NUMBER_TRANSITION="\e[38;5;130m\]\["
         else
             WG_JOBS_NUMBER_CONTENT=""
@@ -46,7 +60,11 @@ else
             WG_ERROR_CODE_TRANSITION="${WG_JOBS_NUMBER_TRANSITION}"
         fi
 
-        export PS1="\[\e[4${USER_BG}\e[3${USER_FG}\e[1m\] \\$ \[\e[0m\e[48;5;241m\e[3${USER_BG}\]\[\e[37m\] $(echo "${PWD}" | sed -r "s|^${HOME}|~|;s|^(.{,${STEP}}/)(.{${STEP},})(/.{${STEP},}$)|\1···\3|;s|^/(.)|//\1|;s|(.)/|\1\\\\[\\\\e[38;5;246m\\\\]  \\\\[\\\\e[37m\\\\]|g") \[\e[0m${WG_JOBS_NUMBER_CONTENT}${WG_ERROR_CODE_CONTENT}${WG_ERROR_CODE_TRANSITION}\e[0m\] "
-    '
+        PS1="\[\e[4${USER_BG}\e[3${USER_FG}\e[1m\] \\$ \[\e[0;48;5;241m\e[3${USER_BG}\]\[\e[37m\] $(echo "${PWD}" | sed -r "s|^${HOME}|~|;s|^(.{,${STEP}}/)(.{${STEP},})(/.{${STEP},}$)|\1···\3|;s|^/(.)|//\1|;s|(.)/|\1\\\\[\\\\e[38;5;246m\\\\]  \\\\[\\\\e[37m\\\\]|g") \[\e[0m${WG_JOBS_NUMBER_CONTENT}${WG_ERROR_CODE_CONTENT}${WG_ERROR_CODE_TRANSITION}\e[0m\] "
+        return ${ERR_CODE}
+    }
+    if [[ ";${PROMPT_COMMAND};" != *";__qb_prompt_update;"* ]]; then
+        PROMPT_COMMAND="__qb_prompt_update${PROMPT_COMMAND:+;${PROMPT_COMMAND}}"
+    fi
 fi
 